@@ -29,6 +29,16 @@ import argparse
 import warnings
 import hashlib
 import html
+import gzip
+import functools
+import itertools
+import sys
+import io
+import contextlib
+import multiprocessing
+from collections import OrderedDict
+from operator import itemgetter
+from concurrent.futures import ProcessPoolExecutor
 
 # 忽略 google.protobuf 的 pkg_resources DEPRECATED 警告
 # 这是 protobuf 库的一个已知问题，与本脚本功能无关
@@ -43,6 +53,18 @@ except ImportError:
     print("请使用 'pip install blackboxprotobuf' 命令进行安装。")
     exit(1)
 
+# 可选依赖，缺少时使用标准库 json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# 可选依赖 (google-re2)，缺少时使用标准库 re
+try:
+    import re2
+except ImportError:
+    re2 = None
+
 # --- 常量定义 ---
 
 # 【文件与路径配置】 - 这些是基础文件名，完整路径将在main函数中构建
@@ -63,11 +85,30 @@ OUTPUT_DIR = ""
 CONFIG_PATH = ""
 TEMPLATE_DIR_PATH = ""
 NON_FRIENDS_CACHE_PATH = ""
+STRICT_CACHE = False # 是否使用SHA256校验非好友缓存
+GZIP_OUTPUT = False # 是否将聊天记录直接写为 .gz 压缩文件
 
 
 # 【核心数据结构缓存】
-SALVAGE_CACHE = {}
-MESSAGE_CONTENT_CACHE = {} # 用于缓存已处理消息的最终文本内容，解决引用信息不完整问题
+_REPLY_CACHE_SIZE = 4096 # 引用原文缓存的默认容量，可由 --reply-cache-size 修改
+
+class _ReplyCache(OrderedDict):
+    """容量有限的时间戳 -> 文本缓存，超出容量时淘汰最早写入的条目。maxsize 为 None 时不限容量。"""
+    def __init__(self, maxsize):
+        super().__init__()
+        self.maxsize = maxsize
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        if self.maxsize and len(self) > self.maxsize:
+            self.popitem(last=False)
+
+SALVAGE_CACHE = _ReplyCache(_REPLY_CACHE_SIZE)
+MESSAGE_CONTENT_CACHE = _ReplyCache(_REPLY_CACHE_SIZE) # 用于缓存已处理消息的最终文本内容，解决引用信息不完整问题
+# 原始消息字节 -> 解析结果。内容完全相同的消息 (表情、系统提示、常用短语等) 只解析一次；
+# 结果依赖导出配置，因此每次写入文件前清空。含引用的消息依赖上下文，不缓存
+PARTS_CACHE = _ReplyCache(8192)
 
 # 【数据库表结构与字段常量】
 # 这些常量基于对QQ NT版数据库的逆向工程得出，是脚本正确读取数据的关键。
@@ -144,6 +185,56 @@ MSG_TYPE_MAP = {
     28: "位置共享提示"
 }
 
+# 分组列表Protobuf的固定结构，解析时直接使用，跳过类型推断
+_GROUP_LIST_TYPEDEF = {
+    PROF_COL_GROUP_LIST_PB: {
+        "type": "message", "name": "",
+        "message_typedef": {
+            PB_GROUP_ID: {"type": "int", "name": ""},
+            PB_GROUP_NAME: {"type": "bytes", "name": ""},
+        },
+    }
+}
+
+# 文件名中不允许出现的字符 -> "_"
+_SANITIZE_TABLE = str.maketrans({c: "_" for c in '\\/*?:"<>|'})
+# 时间字符串中的中文与分隔符统一为 "-" 和 ":"
+_TIME_SEP_TABLE = str.maketrans({'/': '-', '.': '-', '年': '-', '月': '-', '时': ':', '分': ':', '日': None, '秒': None})
+# 时间输入开头的 年-月-日 时:分:秒 部分，年和时分秒可省略，其后多余的文字忽略
+_TIME_RE = re.compile(
+    r'(?:(\d{4}|\d{2})-)?(\d{1,2})-(\d{1,2})'
+    r'(?:\s+(\d{1,2})' r'(?::(\d{1,2})' r'(?::(\d{1,2})' r')?)?)?')
+# 按输入了几个时分秒字段选用的 strptime 格式，由 strptime 校验各字段的范围
+_TIME_FORMATS = ("%Y-%m-%d", "%Y-%m-%d %H", "%Y-%m-%d %H:%M", "%Y-%m-%d %H:%M:%S")
+_TIME_FIELDS = ('year', 'month', 'day', 'hour', 'minute', 'second')
+# 互动灰字提示XML中的用户与文本
+_QQ_UIN_RE = re.compile(r'<qq uin="([^"]+)"')
+_NOR_TXT_RE = re.compile(r'<nor txt="([^"]*)"')
+
+def _compile_linear(pattern):
+    """优先用 re2 (线性时间匹配) 编译正则；未安装或语法不受支持时使用标准库 re。"""
+    if re2 is not None:
+        try:
+            return re2.compile(pattern)
+        except Exception:
+            pass
+    return re.compile(pattern)
+
+# 内容抢救时视为可读的字符。含 \s 与 \u 转义，在 re2 中语义不同或不受支持，因此使用标准库
+_READABLE_RE = re.compile(r"[a-zA-Z0-9\u4e00-\u9fa5\s.,!?;:\'\"()\[\]{}_\-+=*/\\|<>@#$%^&~]+")
+# 内容抢救时优先提取的短标签，如 [图片]
+_SALVAGE_TAG_RE = _compile_linear(r"(\[[^\]]{1,10}\])")
+# 引用消息的提取与改写
+_QUOTE_EXTRACT_RE = re.compile(r'\[引用->(.*)\]')
+_QUOTE_REWRITE_RE = re.compile(r'\[引用->(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}) (.*)\]')
+# 菜单中多选输入的分隔符
+_CHOICE_SPLIT_RE = re.compile(r'[\s,]+')
+# HTML模板中的占位符，切分时保留占位符本身
+_TEMPLATE_SLOT_RE = re.compile(r'(\{\{file_header\}\}|\{\{chat_content\}\})')
+
+# 消息元素类型ID -> 默认显示的标签
+_TYPE_TAG = {k: f"[{v}]" for k, v in MSG_TYPE_MAP.items()}
+
 # 互动表情ID -> 文本描述的映射
 INTERACTIVE_EMOJI_MAP = {
     1: "戳一戳", 2: "比心", 3: "点赞",
@@ -171,23 +262,24 @@ class ConfigManager:
 
     def load_config(self):
         """加载JSON配置文件，如果文件不存在或格式错误，则使用默认配置。"""
-        if os.path.exists(self.config_path):
-            try:
-                with open(self.config_path, 'r', encoding='utf-8') as f:
-                    loaded_config = json.load(f)
-                config = self.default_config.copy()
-                config.update(loaded_config)
-                # 兼容旧版配置
-                if 'export_markdown' in config:
-                    if config['export_markdown']:
-                        config['export_format'] = 'md'
-                    else:
-                        config['export_format'] = 'txt'
-                    del config['export_markdown']
-
-                return config
-            except (json.JSONDecodeError, TypeError):
-                print(f"警告: 配置文件 '{self.config_path}' 格式错误，将使用默认配置。")
+        try:
+            with open(self.config_path, 'r', encoding='utf-8') as f:
+                loaded_config = json.load(f)
+            config = self.default_config.copy()
+            config.update(loaded_config)
+            # 兼容旧版配置
+            if 'export_markdown' in config:
+                if config['export_markdown']:
+                    config['export_format'] = 'md'
+                else:
+                    config['export_format'] = 'txt'
+                del config['export_markdown']
+
+            return config
+        except FileNotFoundError:
+            pass
+        except (json.JSONDecodeError, TypeError):
+            print(f"警告: 配置文件 '{self.config_path}' 格式错误，将使用默认配置。")
         return self.default_config
 
     def save_config(self):
@@ -199,20 +291,54 @@ class ConfigManager:
         except IOError as e:
             print(f"错误: 无法保存配置文件到 '{self.config_path}'。 {e}")
             
+# 只读扫描数据库时的 SQLite 调优
+# 不设置 journal_mode=OFF: 以 mode=ro 打开 WAL 数据库时该 PRAGMA 会报 "disk I/O error"
+# temp_store 保持默认 (磁盘): 会话对象列无索引时 ORDER BY 要对整表消息排序，放在内存中可能耗尽内存
+_READ_PRAGMAS = (
+    "query_only=1", "synchronous=OFF",
+    "mmap_size=268435456", "cache_size=-65536",
+)
+
+def _intern(value):
+    """驻留字符串，其他类型 (如 None 或整数QQ号) 原样返回。"""
+    return sys.intern(value) if type(value) is str else value
+
+def _connect_readonly(db_uri):
+    """以只读方式打开数据库URI (file:...?mode=ro)，并应用只读调优参数。"""
+    con = sqlite3.connect(db_uri, uri=True, cached_statements=256)
+    for pragma in _READ_PRAGMAS:
+        # 调优参数只影响性能，个别不被支持时跳过，不影响打开连接
+        try:
+            con.execute(f"PRAGMA {pragma}")
+        except sqlite3.Error:
+            pass
+    return con
+
+def _has_leading_index(con, table, column):
+    """判断表中是否有以 column 为首列的索引。"""
+    for index in con.execute(f"PRAGMA index_list({table})").fetchall():
+        first = con.execute(f"PRAGMA index_info(`{index[1]}`)").fetchone()
+        if first is not None and first[2] == column:
+            return True
+    return False
+
 class ProfileManager:
     """
     负责从profile_info.db加载和管理所有用户、好友和分组信息。
     这是整个脚本的数据中枢，为其他所有功能提供用户信息支持。
     """
     def __init__(self, db_path):
-        if not os.path.exists(db_path):
-            print(f"错误: 身份数据库文件 '{db_path}' 不存在。")
-            exit(1)
         self.db_path = f"file:{db_path}?mode=ro"
         self.my_uid = ""
         self.my_qq = ""
-        self.all_users = {}   # {uid: {qq, nickname, remark, group_id, ...}} # 包含所有好友和非好友
-        self.friend_uids = set() # 仅好友的UID集合，用于快速判断
+        # 所有用户 (好友和非好友) 的信息按字段分列存放，均以UID为键
+        self.qq = {}          # {uid: qq}，也用于判断UID是否有缓存的用户信息
+        self.nickname = {}    # {uid: 昵称}
+        self.remark = {}      # {uid: 备注}
+        self.qid = {}         # {uid: QID}
+        self.signature = {}   # {uid: 个性签名}
+        self.group_id = {}    # {uid: 分组ID}，非好友为 -1
+        self.friend_uids = frozenset() # 仅好友的UID集合，用于快速判断；加载后不再改动
         self.non_friend_uids = [] # 非好友的UID列表
         self.group_info = {}  # {group_id: group_name} 分组信息
 
@@ -222,17 +348,22 @@ class ProfileManager:
         以 profile_info_v6 作为所有用户的基础信息来源，再用 buddy_list 补充好友特有信息。
         """
         print(f"\n正在从 '{os.path.basename(self.db_path.replace('file:', '').split('?')[0])}' 加载用户信息...")
+        # 不预先检查文件是否存在，只读模式下打开不存在的文件会直接报错
         try:
-            with sqlite3.connect(self.db_path, uri=True) as con:
+            con = _connect_readonly(self.db_path)
+        except sqlite3.OperationalError:
+            print(f"错误: 身份数据库文件 '{self.db_path.replace('file:', '').split('?')[0]}' 不存在或无法打开。")
+            exit(1)
+        try:
+            with con:
                 cur = con.cursor()
                 self._load_my_uid(cur)
                 self._load_groups(cur)
                 self._load_all_profiles(cur) # 先加载所有缓存用户
                 self._enrich_friends_info(cur) # 再用好友列表补充信息
                 
-                if self.my_uid in self.all_users:
-                    my_profile = self.all_users[self.my_uid]
-                    self.my_qq = my_profile.get('qq', 'master')
+                if self.my_uid in self.qq:
+                    self.my_qq = self.qq[self.my_uid]
                 
                 print("用户信息加载完毕。")
         except sqlite3.Error as e:
@@ -254,38 +385,48 @@ class ProfileManager:
         pb_data = cur.fetchone()
         if not pb_data or not pb_data[0]: return
 
-        decoded, _ = blackboxprotobuf.decode_message(pb_data[0])
+        try:
+            decoded, _ = blackboxprotobuf.decode_message(pb_data[0], _GROUP_LIST_TYPEDEF)
+        except Exception:
+            # 结构与预设不符时回退到类型推断
+            decoded, _ = blackboxprotobuf.decode_message(pb_data[0])
         group_list_data = decoded.get(PROF_COL_GROUP_LIST_PB)
         if not group_list_data: return
         
         groups = group_list_data if isinstance(group_list_data, list) else [group_list_data]
-        for group in groups:
-            group_id = group.get(PB_GROUP_ID)
-            group_name = group.get(PB_GROUP_NAME, b'').decode('utf-8', 'ignore')
-            if group_id is not None and group_name:
-                self.group_info[group_id] = group_name
+        # 按预设结构解析时名称均为bytes，只有回退到类型推断时才可能得到str
+        self.group_info.update({
+            g[PB_GROUP_ID]: name if isinstance(name, str) else name.decode('utf-8', 'ignore')
+            for g in groups if g.get(PB_GROUP_ID) is not None and (name := g.get(PB_GROUP_NAME))
+        })
 
     def _load_all_profiles(self, cur):
         """将profile_info_v6表的内容全部加载到字典，作为所有用户的信息基础。"""
         query = f'SELECT "{PROF_COL_UID}", "{PROF_COL_QQ}", "{PROF_COL_NICKNAME}", "{PROF_COL_REMARK}", "{PROF_COL_QID}", "{PROF_COL_SIGNATURE}" FROM {PROFILE_INFO_TABLE}'
         cur.execute(query)
-        for uid, qq, nickname, remark, qid, signature in cur.fetchall():
-            self.all_users[uid] = {
-                'qq': qq or uid, 'nickname': nickname or '', 'remark': remark or '', 
-                'qid': qid or '', 'signature': signature or '', 'is_friend': False, 'group_id': -1
-            }
+        for uid, qq, nickname, remark, qid, signature in cur: # 逐行读取，不先拼出整张表的列表
+            # UID、QQ号和昵称会在各处反复作为键或值出现，驻留后共享同一个对象
+            uid = _intern(uid)
+            self.qq[uid] = _intern(qq) or uid
+            self.nickname[uid] = _intern(nickname) or ''
+            self.remark[uid] = _intern(remark) or ''
+            self.qid[uid] = qid or ''
+            self.signature[uid] = signature or ''
+            self.group_id[uid] = -1
 
     def _enrich_friends_info(self, cur):
-        """以buddy_list为准，在all_users中补充好友的详细信息（如分组），并标记为好友。"""
+        """以buddy_list为准，补充好友的详细信息（如分组），并标记为好友。"""
         query = f'SELECT "{PROF_COL_UID}", "{PROF_COL_QQ}", "{PROF_COL_GROUP_ID}" FROM {BUDDY_LIST_TABLE}'
         cur.execute(query)
-        for friend_uid, friend_qq, friend_group_id in cur.fetchall():
-            self.friend_uids.add(friend_uid)
-            if friend_uid in self.all_users:
-                self.all_users[friend_uid]['is_friend'] = True
-                self.all_users[friend_uid]['group_id'] = friend_group_id if friend_group_id is not None else 0
+        friend_uids = set()
+        for friend_uid, friend_qq, friend_group_id in cur:
+            friend_uid = _intern(friend_uid)
+            friend_uids.add(friend_uid)
+            if friend_uid in self.qq:
+                self.group_id[friend_uid] = friend_group_id if friend_group_id is not None else 0
                 if friend_qq: # buddy_list中的qq号可能更准
-                    self.all_users[friend_uid]['qq'] = friend_qq
+                    self.qq[friend_uid] = _intern(friend_qq)
+        self.friend_uids = frozenset(friend_uids)
 
     def load_non_friends(self, config_mgr):
         """扫描消息数据库，找出并缓存所有非好友的UID。"""
@@ -293,67 +434,80 @@ class ProfileManager:
             self.non_friend_uids = []
             return
 
-        msg_db_hash = _calculate_sha256(DB_PATH)
-        profile_db_hash = _calculate_sha256(PROFILE_DB_PATH)
+        # 默认以文件大小和修改时间判断数据库是否变化，--strict-cache 时校验SHA256
+        db_ids = _database_ids(STRICT_CACHE)
 
         # 尝试从缓存加载
         try:
-            if os.path.exists(NON_FRIENDS_CACHE_PATH):
-                with open(NON_FRIENDS_CACHE_PATH, 'r', encoding='utf-8') as f:
-                    cache_data = json.load(f)
-                    if cache_data.get('msg_db_hash') == msg_db_hash and cache_data.get('profile_db_hash') == profile_db_hash:
-                        self.non_friend_uids = cache_data.get('uids', [])
-                        print(f"已从缓存加载 {len(self.non_friend_uids)} 个非好友/临时会话用户。")
-                        return
+            with open(NON_FRIENDS_CACHE_PATH, 'r', encoding='utf-8') as f:
+                cache_data = json.load(f)
+            # 旧版缓存只记录了SHA256，校验一次后迁移为新格式
+            is_legacy = 'msg_db_fp' not in cache_data
+            if is_legacy and not STRICT_CACHE:
+                db_ids = _database_ids(True)
+            keys = ('msg_db_hash', 'profile_db_hash') if STRICT_CACHE or is_legacy else ('msg_db_fp', 'profile_db_fp')
+            if all(cache_data.get(k) == db_ids[k] for k in keys):
+                self.non_friend_uids = cache_data.get('uids', [])
+                print(f"已从缓存加载 {len(self.non_friend_uids)} 个非好友/临时会话用户。")
+                if is_legacy:
+                    self._save_non_friends_cache(db_ids)
+                return
+        except FileNotFoundError:
+            pass
         except (json.JSONDecodeError, IOError) as e:
             print(f"警告：读取非好友缓存文件失败，将重新扫描。错误：{e}")
 
         # 缓存无效或不存在，重新扫描
         print("正在扫描消息数据库以识别非好友/临时会话...")
-        if not os.path.exists(DB_PATH):
+        try:
+            con = _connect_readonly(f"file:{DB_PATH}?mode=ro")
+        except sqlite3.OperationalError:
             print(f"错误: 消息数据库文件 '{DB_PATH}' 不存在，无法扫描非好友。")
             return
-            
-        all_peer_uids = set()
+
+        # 会话对象列有索引时由SQLite沿索引去重；没有索引时 DISTINCT 需要建临时B树
+        # 排序全部行，不如直接顺序扫描并在Python中用集合去重。两种方式都排除好友和自己
+        excluded_uids = self.friend_uids | {self.my_uid}
         try:
-            with sqlite3.connect(f"file:{DB_PATH}?mode=ro", uri=True) as con:
-                cur = con.cursor()
-                cur.execute(f"SELECT DISTINCT `{COL_PEER_UID}` FROM {TABLE_NAME}")
-                rows = cur.fetchall()
-                for row in rows:
-                    if row[0]:
-                        all_peer_uids.add(row[0])
+            with con:
+                if _has_leading_index(con, TABLE_NAME, COL_PEER_UID):
+                    print("  (会话对象列有索引，由数据库去重)")
+                    query = f"SELECT DISTINCT `{COL_PEER_UID}` FROM {TABLE_NAME}"
+                else:
+                    print("  (会话对象列无索引，顺序扫描去重)")
+                    query = f"SELECT `{COL_PEER_UID}` FROM {TABLE_NAME}"
+                cur = con.execute(query)
+                potential_non_friends = {uid for (uid,) in cur if uid and uid not in excluded_uids}
         except sqlite3.Error as e:
             print(f"错误: 扫描消息数据库时出错: {e}")
             return
         
-        potential_non_friends = all_peer_uids - self.friend_uids - {self.my_uid}
         # 过滤掉没有昵称的非好友
         valid_non_friends = [
             uid for uid in potential_non_friends 
-            if self.all_users.get(uid, {}).get('nickname')
+            if self.nickname.get(uid)
         ]
         
         self.non_friend_uids = sorted(list(valid_non_friends))
         print(f"扫描完成，发现 {len(self.non_friend_uids)} 个有效的非好友/临时会话用户。")
 
         # 保存到缓存
+        self._save_non_friends_cache(db_ids)
+
+    def _save_non_friends_cache(self, db_ids):
+        """将非好友UID列表连同数据库标识写入缓存文件。"""
         try:
             with open(NON_FRIENDS_CACHE_PATH, 'w', encoding='utf-8') as f:
-                cache_to_save = {
-                    'msg_db_hash': msg_db_hash,
-                    'profile_db_hash': profile_db_hash,
-                    'uids': self.non_friend_uids
-                }
+                cache_to_save = dict(db_ids, uids=self.non_friend_uids)
                 json.dump(cache_to_save, f, indent=4)
         except IOError as e:
             print(f"警告: 无法写入非好友缓存文件。错误: {e}")
 
     def get_display_name(self, uid, style, custom_format=""):
         """根据用户选择的风格，获取一个UID对应的显示名称。"""
-        user = self.all_users.get(uid)
-        if not user: return uid
-        qq, nickname, remark = user.get('qq', uid), user.get('nickname', ''), user.get('remark', '')
+        qq = self.qq.get(uid)
+        if qq is None: return uid
+        nickname, remark = self.nickname[uid], self.remark[uid]
         default_name = remark or nickname or str(qq)
         
         if style == 'default': return default_name
@@ -369,66 +523,85 @@ class ProfileManager:
     def get_filename(self, uid, timestamp_str, export_format='md'):
         """为一对一聊天记录生成标准的文件名，并附加时间戳。"""
         ext = f".{export_format}"
-        user = self.all_users.get(uid)
-        if not user: return f"{uid}{timestamp_str}{ext}"
+        if uid not in self.qq: return f"{uid}{timestamp_str}{ext}"
         
-        qq = str(user.get('qq', uid))
-        nickname = user.get('nickname', '')
-        remark = user.get('remark', '')
+        qq = str(self.qq[uid])
+        nickname = self.nickname[uid]
+        remark = self.remark[uid]
         
         # 核心逻辑修正与新增
         name_part = nickname or qq
         remark_part = f"(备注-{remark})" if remark else ""
-        is_non_friend_tag = "_[非好友]" if not user.get('is_friend', False) else ""
+        is_non_friend_tag = "_[非好友]" if uid not in self.friend_uids else ""
         
-        safe_name_part = re.sub(r'[\\/*?:"<>|]', "_", name_part) or qq
-        safe_remark_part = re.sub(r'[\\/*?:"<>|]', "_", remark_part)
+        safe_name_part = name_part.translate(_SANITIZE_TABLE) or qq
+        safe_remark_part = remark_part.translate(_SANITIZE_TABLE)
         
         return f"{qq}{is_non_friend_tag}_{safe_name_part}{safe_remark_part}{timestamp_str}{ext}"
 
 # --- 时间与文件处理函数 ---
+_HASH_BLOCK_SIZE = 1 << 20 # 计算哈希时每次读取的字节数
+
+_SHA256_CACHE = {} # {(路径, 大小, 修改时间): 哈希值}，每个导出文件的文件头都要用到，文件未变化时不重复计算
+
 def _calculate_sha256(filepath):
     """计算文件的SHA256哈希值"""
-    sha256_hash = hashlib.sha256()
     try:
+        st = os.stat(filepath)
+        key = (filepath, st.st_size, st.st_mtime_ns)
+        if key in _SHA256_CACHE: return _SHA256_CACHE[key]
         with open(filepath, "rb") as f:
-            for byte_block in iter(lambda: f.read(4096), b""):
-                sha256_hash.update(byte_block)
-        return sha256_hash.hexdigest()
+            if hasattr(hashlib, "file_digest"): # Python 3.11+，在C层按大块读取
+                digest = hashlib.file_digest(f, "sha256").hexdigest()
+            else:
+                sha256_hash = hashlib.sha256()
+                buf = memoryview(bytearray(_HASH_BLOCK_SIZE))
+                while n := f.readinto(buf):
+                    sha256_hash.update(buf[:n])
+                digest = sha256_hash.hexdigest()
+        _SHA256_CACHE[key] = digest
+        return digest
     except FileNotFoundError:
         return "文件未找到"
     except Exception as e:
         return f"计算错误: {e}"
 
+def _fingerprint(filepath):
+    """以文件大小和修改时间 (纳秒) 作为文件的廉价标识，用于判断文件是否变化。"""
+    try:
+        st = os.stat(filepath)
+    except FileNotFoundError:
+        return "文件未找到"
+    return f"{st.st_size}:{st.st_mtime_ns}"
+
+def _database_ids(with_hash=False):
+    """返回两个数据库的标识，with_hash 时额外计算SHA256。"""
+    db_ids = {'msg_db_fp': _fingerprint(DB_PATH), 'profile_db_fp': _fingerprint(PROFILE_DB_PATH)}
+    if with_hash:
+        db_ids['msg_db_hash'] = _calculate_sha256(DB_PATH)
+        db_ids['profile_db_hash'] = _calculate_sha256(PROFILE_DB_PATH)
+    return db_ids
+
 def _parse_time_string(input_str: str) -> dict or None:
     """
     极度人性化地解析各种日期时间格式。
     返回一个包含年月日时分秒的字典，未提供则为None。
     """
     if not input_str: return None
-    s = input_str.strip()
-    s = re.sub(r'[/.年月]', '-', s)
-    s = re.sub(r'[时分]', ':', s)
-    s = re.sub(r'[日秒]', '', s)
-    s = s.strip()
-    match = re.match(
-        r'(?:(\d{4}|\d{2})-)?(\d{1,2})-(\d{1,2})'
-        r'(?:\s+(\d{1,2})' r'(?::(\d{1,2})' r'(?::(\d{1,2})' r')?)?)?', s)
+    s = input_str.strip().translate(_TIME_SEP_TABLE).strip()
+    match = _TIME_RE.match(s)
     if not match: return None
-    year, month, day, hour, minute, second = match.groups()
-    now = datetime.now()
-    if year:
-        if len(year) == 2: year = f"20{year}"
-    else: year = str(now.year)
-    try:
-        datetime(int(year), int(month), int(day))
+    year, month, day, *clock = match.groups()
+    # 补全年份：省略时取今年，两位数年份视为20xx
+    if not year: year = datetime.now().year
+    elif len(year) == 2: year = f"20{year}"
+    clock = [v for v in clock if v is not None]
+    text = f"{year}-{month}-{day} {':'.join(clock)}" if clock else f"{year}-{month}-{day}"
+    try: dt = datetime.strptime(text, _TIME_FORMATS[len(clock)])
     except ValueError: return None
-    return {
-        'year': int(year), 'month': int(month), 'day': int(day),
-        'hour': int(hour) if hour is not None else None,
-        'minute': int(minute) if minute is not None else None,
-        'second': int(second) if second is not None else None
-    }
+    count = 3 + len(clock)
+    values = (dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second)
+    return dict(zip(_TIME_FIELDS, values[:count] + (None,) * (6 - count)))
 
 def get_time_range(path_title):
     """
@@ -504,119 +677,154 @@ def _extract_readable_text(data: bytes) -> str or None:
     if not data: return None
     try:
         decoded_str = data.decode("utf-8", errors="replace")
-        pattern = r"[a-zA-Z0-9\u4e00-\u9fa5\s.,!?;:\'\"()\[\]{}_\-+=*/\\|<>@#$%^&~]+"
-        fragments = re.findall(pattern, decoded_str)
-        return max(fragments, key=len).strip() if fragments else None
+        # 只记录最长片段的位置，不生成中间的片段列表
+        best_len, best_start, best_end = 0, 0, 0
+        for match in _READABLE_RE.finditer(decoded_str):
+            start, end = match.span()
+            if end - start > best_len:
+                best_len, best_start, best_end = end - start, start, end
+        return decoded_str[best_start:best_end].strip() or None
     except Exception: return None
 
-def _parse_single_segment(segment: dict, export_config: dict) -> str:
-    """内部辅助函数，为引用消息提供原文的文本摘要，或为其他消息提供基础解析。"""
-    if not isinstance(segment, dict): return ""
-    msg_type = segment.get(PB_MSG_TYPE)
+def _b2s(segment: dict, key: str) -> str:
+    """取出字段的bytes并按UTF-8解码 (忽略错误)，字段不存在时返回空字符串。"""
+    value = segment.get(key)
+    return value.decode('utf-8', 'ignore') if value is not None else ""
+
+def _b2s_san(segment: dict, key: str) -> str:
+    """同 _b2s，并替换换行符；原始字节中没有换行时跳过替换。"""
+    value = segment.get(key)
+    if value is None: return ""
+    text = value.decode('utf-8', 'ignore')
+    return text.replace("\n", "[%\\n%]") if b"\n" in value else text
+
+def _seg_emoji(segment: dict, export_config: dict) -> str:
+    """QQ表情"""
+    get = segment.get
+    # 优先判断是否为互动表情
+    is_interactive_from_subtype = (get(PB_MSG_SUBTYPE) == 5)
     
-    if msg_type == 6:  # QQ表情
-        # 优先判断是否为互动表情
-        is_interactive_from_subtype = (segment.get(PB_MSG_SUBTYPE) == 5)
+    # 尝试从原始消息字段(47611)和引用内嵌对象字段(47601)获取互动ID
+    action_id = get(PB_INTERACTIVE_EMOJI_ID)
+    if action_id is None:
+        action_id = get(PB_INTERACTIVE_EMOJI_ID_IN_QUOTE)
         
-        # 尝试从原始消息字段(47611)和引用内嵌对象字段(47601)获取互动ID
-        action_id = segment.get(PB_INTERACTIVE_EMOJI_ID)
-        if action_id is None:
-            action_id = segment.get(PB_INTERACTIVE_EMOJI_ID_IN_QUOTE)
-            
-        # 如果是互动表情子类型，或通过ID在映射表中找到了，则按互动表情处理
-        if is_interactive_from_subtype or (action_id in INTERACTIVE_EMOJI_MAP):
-            action_text = INTERACTIVE_EMOJI_MAP.get(action_id, "未知互动")
-            return f"[互动表情: {action_text}]"
-        else: # 否则，按普通表情处理
-            desc = segment.get(PB_EMOJI_DESC, b'').decode('utf-8', 'ignore')
-            return f"[QQ表情: {desc.lstrip('/')}]" if desc else "[QQ表情]"
-            
-    if msg_type == 2: # 图片类
-        subtype = segment.get(PB_MSG_SUBTYPE)
-        # 优先处理特殊动画表情（如“嘿嘿”）
-        if subtype == 7:
-            desc_list = segment.get(PB_STICKER_DESC, [])
-            # desc_list中的项是bytes类型
-            return desc_list[0].decode('utf-8', 'ignore') if desc_list else "[动画表情]"
-
-        # 其次处理普通动画表情和超级QQ秀
-        if subtype in [1, 2]:
-            apollo_text_raw = segment.get(PB_APOLLO_TEXT)
-            if apollo_text_raw:
-                apollo_text = apollo_text_raw.decode('utf-8', 'ignore')
-                return f"[超级QQ秀: {apollo_text}]"
-            else:
-                return "[动画表情]"
-        
-        # 最后处理静态图片和闪照
-        tag = "[闪照" if segment.get(PB_IMAGE_IS_FLASH) == 1 else "[图片"
-        if export_config.get('show_media_info'):
-            width = segment.get(PB_IMG_WIDTH)
-            height = segment.get(PB_IMG_HEIGHT)
-            if width and height:
-                return f"{tag} {width}x{height}]"
-        return f"{tag}]"
-
-    if msg_type == 3: # 文件
-        filename_raw = segment.get(PB_FILE_NAME, b'')
-        filename = filename_raw.decode('utf-8', 'ignore')
-        return f"[文件: {filename}]" if filename else "[文件]"
-        
-    if msg_type == 5: # 视频
-        tag = "[视频"
-        if export_config.get('show_media_info'):
-            width = segment.get(PB_VID_WIDTH, 0)
-            height = segment.get(PB_VID_HEIGHT, 0)
-            duration_sec = segment.get(PB_VID_DURATION, 0)
-            
-            parts = []
-            if width > 0 and height > 0:
-                parts.append(f"{width}x{height}")
-            if duration_sec > 0:
-                duration_str = f"{duration_sec // 60:02d}:{duration_sec % 60:02d}"
-                parts.append(duration_str)
-            if parts:
-                return f"[视频 {' '.join(parts)}]"
-        return f"[视频]"
-
-    if msg_type == 4: # 语音
-        duration = segment.get(PB_VOICE_DURATION)
-        return f'[语音] {duration}"' if isinstance(duration, int) and duration > 0 else "[语音]"
-        
-    if msg_type == 9: # 红包
-        title = segment.get("48403", {}).get(PB_REDPACKET_TITLE, b"").decode("utf-8", "ignore")
-        rp_type = segment.get(PB_REDPACKET_TYPE)
-        if rp_type == 2:
-            return f"[普通红包] {title}"
-        elif rp_type == 6:
-            return f"[口令红包] {title}"
-        elif rp_type == 15:
-            return f"[语音红包] {title}"
+    # 如果是互动表情子类型，或通过ID在映射表中找到了，则按互动表情处理
+    action_text = INTERACTIVE_EMOJI_MAP.get(action_id)
+    if is_interactive_from_subtype or action_text is not None:
+        return f"[互动表情: {action_text or '未知互动'}]"
+    else: # 否则，按普通表情处理
+        desc = _b2s(segment, PB_EMOJI_DESC)
+        return f"[QQ表情: {desc.lstrip('/')}]" if desc else "[QQ表情]"
+
+def _seg_image(segment: dict, export_config: dict) -> str:
+    """图片类"""
+    get = segment.get
+    subtype = get(PB_MSG_SUBTYPE)
+    # 优先处理特殊动画表情（如“嘿嘿”）
+    if subtype == 7:
+        desc_list = get(PB_STICKER_DESC, [])
+        # desc_list中的项是bytes类型
+        return desc_list[0].decode('utf-8', 'ignore') if desc_list else "[动画表情]"
+
+    # 其次处理普通动画表情和超级QQ秀
+    if subtype in [1, 2]:
+        apollo_text_raw = get(PB_APOLLO_TEXT)
+        if apollo_text_raw:
+            apollo_text = apollo_text_raw.decode('utf-8', 'ignore')
+            return f"[超级QQ秀: {apollo_text}]"
         else:
-            return f"[红包] {title}"
-            
-    if msg_type == 11 and PB_MARKET_FACE_TEXT in segment:
-        text = segment[PB_MARKET_FACE_TEXT].decode("utf-8", "ignore")
-        return _sanitize_newlines(text)
-    if msg_type == 27:
-        text = segment.get(PB_GIFT_TEXT, b'').decode('utf-8', 'ignore')
-        return _sanitize_newlines(text) if text else "[礼物]"
-    if msg_type == 28:
-        text = segment.get(PB_LOCATION_SHARE_TEXT, b'').decode('utf-8', 'ignore')
-        return f"[{_sanitize_newlines(text)}]" if text else "[位置共享]"
+            return "[动画表情]"
+    
+    # 最后处理静态图片和闪照
+    tag = "[闪照" if get(PB_IMAGE_IS_FLASH) == 1 else "[图片"
+    if export_config.get('show_media_info'):
+        width = get(PB_IMG_WIDTH)
+        height = get(PB_IMG_HEIGHT)
+        if width and height:
+            return f"{tag} {width}x{height}]"
+    return f"{tag}]"
+
+def _seg_file(segment: dict, export_config: dict) -> str:
+    """文件"""
+    filename = _b2s(segment, PB_FILE_NAME)
+    return f"[文件: {filename}]" if filename else "[文件]"
+
+def _seg_video(segment: dict, export_config: dict) -> str:
+    """视频"""
+    get = segment.get
+    if export_config.get('show_media_info'):
+        width = get(PB_VID_WIDTH, 0)
+        height = get(PB_VID_HEIGHT, 0)
+        duration_sec = get(PB_VID_DURATION, 0)
         
+        parts = []
+        if width > 0 and height > 0:
+            parts.append(f"{width}x{height}")
+        if duration_sec > 0:
+            duration_str = f"{duration_sec // 60:02d}:{duration_sec % 60:02d}"
+            parts.append(duration_str)
+        if parts:
+            return f"[视频 {' '.join(parts)}]"
+    return "[视频]"
+
+def _seg_voice(segment: dict, export_config: dict) -> str:
+    """语音"""
+    duration = segment.get(PB_VOICE_DURATION)
+    return f'[语音] {duration}"' if isinstance(duration, int) and duration > 0 else "[语音]"
+
+def _seg_redpacket(segment: dict, export_config: dict) -> str:
+    """红包"""
+    get = segment.get
+    title = _b2s(get("48403", {}), PB_REDPACKET_TITLE)
+    rp_type = get(PB_REDPACKET_TYPE)
+    if rp_type == 2:
+        return f"[普通红包] {title}"
+    elif rp_type == 6:
+        return f"[口令红包] {title}"
+    elif rp_type == 15:
+        return f"[语音红包] {title}"
+    else:
+        return f"[红包] {title}"
+
+def _seg_market_face(segment: dict, export_config: dict) -> str:
+    """商城表情，缺少文本时按普通消息处理"""
+    if PB_MARKET_FACE_TEXT in segment:
+        return _b2s_san(segment, PB_MARKET_FACE_TEXT)
+    return _seg_default(segment, export_config)
+
+def _seg_gift(segment: dict, export_config: dict) -> str:
+    """礼物"""
+    return _b2s_san(segment, PB_GIFT_TEXT) or "[礼物]"
+
+def _seg_location_share(segment: dict, export_config: dict) -> str:
+    """位置共享提示"""
+    text = _b2s_san(segment, PB_LOCATION_SHARE_TEXT)
+    return f"[{text}]" if text else "[位置共享]"
+
+def _seg_default(segment: dict, export_config: dict) -> str:
+    """文本及其他类型：有文本内容时输出文本，否则输出类型标签"""
     if PB_TEXT_CONTENT in segment:
-        text = segment.get(PB_TEXT_CONTENT, b"").decode("utf-8", "ignore")
-        return _sanitize_newlines(text)
+        return _b2s_san(segment, PB_TEXT_CONTENT)
+    return _TYPE_TAG.get(segment.get(PB_MSG_TYPE), "[消息]")
 
-    return f"[{MSG_TYPE_MAP.get(msg_type, '消息')}]"
+# 消息元素类型ID -> 解析函数，未登记的类型 (包括文本) 由 _seg_default 处理
+_SEGMENT_HANDLERS = {
+    2: _seg_image, 3: _seg_file, 4: _seg_voice, 5: _seg_video, 6: _seg_emoji,
+    9: _seg_redpacket, 11: _seg_market_face, 27: _seg_gift, 28: _seg_location_share
+}
+
+def _parse_single_segment(segment: dict, export_config: dict) -> str:
+    """内部辅助函数，为引用消息提供原文的文本摘要，或为其他消息提供基础解析。"""
+    if not isinstance(segment, dict): return ""
+    return _SEGMENT_HANDLERS.get(segment.get(PB_MSG_TYPE), _seg_default)(segment, export_config)
 
 def _decode_interactive_gray_tip(segment: dict, profile_mgr, name_style, name_format) -> dict or None:
     """解析互动式灰字提示（如戳一戳、拍一拍），返回结构化字典用于后续特殊格式化。"""
     try:
-        xml = segment.get(PB_GRAYTIP_INTERACTIVE_XML, b"").decode("utf-8", "ignore")
-        uids = re.findall(r'<qq uin="([^"]+)"', xml)
-        texts = re.findall(r'<nor txt="([^"]*)"', xml)
+        xml = _b2s(segment, PB_GRAYTIP_INTERACTIVE_XML)
+        uids = _QQ_UIN_RE.findall(xml)
+        texts = _NOR_TXT_RE.findall(xml)
         if len(uids) >= 2 and len(texts) >= 1:
             actor = profile_mgr.get_display_name(uids[0], name_style, name_format)
             target = profile_mgr.get_display_name(uids[1], name_style, name_format)
@@ -638,7 +846,8 @@ def decode_gray_tip(segment: dict, profile_mgr, name_style, name_format, export_
         if not export_config.get('show_recall'):
             return None
         
-        recaller_uid_raw = segment.get(PB_RECALLER_UID)
+        get = segment.get
+        recaller_uid_raw = get(PB_RECALLER_UID)
         recaller_uid = ""
         if isinstance(recaller_uid_raw, bytes):
             recaller_uid = recaller_uid_raw.decode('utf-8', 'ignore')
@@ -648,7 +857,7 @@ def decode_gray_tip(segment: dict, profile_mgr, name_style, name_format, export_
         display_name = profile_mgr.get_display_name(recaller_uid, name_style, name_format)
         
         if display_name == recaller_uid:
-            fallback_name_raw = segment.get(PB_RECALLER_NAME)
+            fallback_name_raw = get(PB_RECALLER_NAME)
             if isinstance(fallback_name_raw, bytes):
                 display_name = fallback_name_raw.decode('utf-8', 'ignore') or recaller_uid
             elif isinstance(fallback_name_raw, str):
@@ -656,7 +865,7 @@ def decode_gray_tip(segment: dict, profile_mgr, name_style, name_format, export_
 
         recall_suffix = ""
         if export_config.get('show_recall_suffix'):
-            recall_suffix_raw = segment.get(PB_RECALL_SUFFIX)
+            recall_suffix_raw = get(PB_RECALL_SUFFIX)
             temp_suffix = ""
             if isinstance(recall_suffix_raw, bytes):
                 temp_suffix = recall_suffix_raw.decode('utf-8', 'ignore')
@@ -672,12 +881,21 @@ def decode_gray_tip(segment: dict, profile_mgr, name_style, name_format, export_
 
     return None # 过滤掉所有其他类型的灰字提示
 
+def _loads_ark_json(raw):
+    """解析Ark卡片的JSON。优先用 orjson 直接解析 bytes；其无法处理时 (如含非法UTF-8字节) 回退到标准库。"""
+    if orjson is not None:
+        try:
+            return orjson.loads(raw)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(raw.decode("utf-8", "ignore") if isinstance(raw, bytes) else raw)
+
 def decode_ark_message(segment: dict) -> str or None:
     """解析并过滤Ark卡片消息，只保留需要的类型。"""
     try:
         json_str = segment.get(PB_ARK_JSON)
         if not json_str: return None
-        data = json.loads(json_str.decode("utf-8", "ignore") if isinstance(json_str, bytes) else json_str)
+        data = _loads_ark_json(json_str)
         app, prompt = data.get("app"), data.get("prompt", "")
         
         if app == "com.tencent.map" and data.get("view") == "LocationShare":
@@ -707,80 +925,322 @@ def decode_ark_message(segment: dict) -> str or None:
         return None
     except Exception: return "[卡片-解析失败]"
 
-def decode_message_content(content, timestamp, profile_mgr, name_style, name_format, export_config, is_timeline=False) -> list or None:
+def _decode_protobuf(content):
+    """
+    解析消息的Protobuf数据，失败时抛出异常。
+    每条消息都重新推断类型：套用别的消息推断出的 typedef 时，嵌套消息可能被静默解析成 bytes。
+    只有 _GROUP_LIST_TYPEDEF 这类结构固定的 typedef 才可以预先给出。
+    """
+    return blackboxprotobuf.decode_message(content)[0]
+
+_CONTAINER_FIELD = int(PB_MSG_CONTAINER)
+
+def _read_varint(data, pos):
+    """从 pos 处读取一个varint，返回 (值, 新位置)，数据不完整时返回 (None, None)。"""
+    value, shift, end = 0, 0, len(data)
+    while pos < end:
+        b = data[pos]
+        pos += 1
+        value |= (b & 0x7F) << shift
+        if b < 0x80: return value, pos
+        shift += 7
+    return None, None
+
+def _lacks_container(content) -> bool:
+    """
+    只按长度跳过顶层字段而不解析内容，确认其中没有消息容器字段。
+    这类消息不必做完整的Protobuf解析；数据不是规整的Protobuf时返回 False，
+    交给完整解析和内容抢救处理。
+    """
+    pos, end = 0, len(content)
+    while pos < end:
+        key, pos = _read_varint(content, pos)
+        if key is None or key >> 3 == _CONTAINER_FIELD: return False
+        wire_type = key & 7
+        if wire_type == 0: _, pos = _read_varint(content, pos)
+        elif wire_type == 2:
+            length, pos = _read_varint(content, pos)
+            if pos is not None: pos += length
+        elif wire_type == 1: pos += 8
+        elif wire_type == 5: pos += 4
+        else: return False
+        if pos is None: return False
+    return pos == end
+
+# --- 并行解析 ---
+# Protobuf解析是纯Python的CPU密集操作，消息较多时交给子进程并行完成；
+# 引用缓存和用户名等依赖顺序的处理仍在主进程中进行
+_DECODE_POOL = None     # 解析用的进程池，由 main 在导出期间创建
+_POOL_CHUNK_SIZE = 256  # 每次分发给子进程的消息数
+_POOL_MIN_ROWS = 2048   # 少于此数量的消息直接在主进程中解析
+_PREFILTER_BATCH_ROWS = 16384 # 从游标中逐批取出消息预处理，不必一次读入全部原始行
+
+def _try_decode_protobuf(content):
+    """在子进程中解析一条消息，失败时返回 None，由主进程重新解析并走内容抢救流程。"""
+    if not content or _lacks_container(content): return None
+    try:
+        return _decode_protobuf(content)
+    except Exception:
+        return None
+
+def _open_decode_pool(jobs):
+    """创建解析进程池。jobs 不大于1或平台不支持 fork 时返回 None，此时在主进程中解析。"""
+    if jobs <= 1:
+        return None
+    try:
+        pool = ProcessPoolExecutor(jobs, mp_context=multiprocessing.get_context("fork"))
+        # 在启动其他线程之前 fork 出全部子进程
+        pool.submit(int).result()
+    except (ImportError, NotImplementedError, OSError, ValueError):
+        return None
+    return pool
+
+def _predecode_rows(rows):
+    """
+    把 rows 中消息的Protobuf提交给进程池解析，立即返回与 rows 对齐的结果迭代器，
+    取值时才等待对应的结果。未启用进程池或消息较少时返回 None。
+    """
+    if _DECODE_POOL is None or len(rows) < _POOL_MIN_ROWS:
+        return None
+    contents = [row[3] for row in rows]
+    return _DECODE_POOL.map(_try_decode_protobuf, contents, chunksize=_POOL_CHUNK_SIZE)
+
+# --- 按好友并行导出 ---
+# 单独文件模式下各好友的导出互不依赖，直接以好友为单位分给子进程；
+# 子进程经 fork 继承导出配置和用户资料，各自以只读方式打开数据库
+_FRIEND_CONFIG = None   # 子进程使用的导出配置，在创建进程池之前设置
+_WORKER_CON = None      # 子进程各自的数据库连接
+
+def _init_friend_worker():
+    """子进程初始化：打开自己的只读连接，并丢弃从父进程继承来的解析进程池。"""
+    global _WORKER_CON, _DECODE_POOL
+    _DECODE_POOL = None
+    _WORKER_CON = _connect_readonly(f"file:{DB_PATH}?mode=ro")
+
+def _export_friend_captured(con, config, task, rows=None):
+    """导出一个好友，返回其间打印的内容，由调用方按原顺序输出。"""
+    uid, out_dir, index, total = task
+    _clear_reply_caches()
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        export_one_on_one(con, uid, config, {'type': 'individual', 'friend_uid': uid}, out_dir, index, total, rows)
+    return out.getvalue()
+
+def _export_friend_task(task):
+    """在子进程中导出一个好友。"""
+    return _export_friend_captured(_WORKER_CON, _FRIEND_CONFIG, task)
+
+# 一条语句中最多绑定的会话对象UID数；SQLite 3.32 之前每条语句最多只允许 999 个参数
+_MAX_PEERS_PER_QUERY = 900
+
+def _peers_where(config, uids):
+    """生成限定会话对象为 uids 且在导出时间范围内的 WHERE 子句，返回 (子句, 参数)。"""
+    clauses = [f"`{COL_PEER_UID}` IN ({', '.join('?' for _ in uids)})"]
+    params = list(uids)
+    if config['start_ts']:
+        clauses.append(f"`{COL_TIMESTAMP}` >= ?")
+        params.append(config['start_ts'])
+    if config['end_ts']:
+        clauses.append(f"`{COL_TIMESTAMP}` <= ?")
+        params.append(config['end_ts'])
+    return f" WHERE {' AND '.join(clauses)}", params
+
+def _peers_with_messages(con, config, uids):
+    """找出 uids 中在导出时间范围内有消息的好友，每次查询最多 _MAX_PEERS_PER_QUERY 个。"""
+    peers = set()
+    for start in range(0, len(uids), _MAX_PEERS_PER_QUERY):
+        where, params = _peers_where(config, uids[start:start + _MAX_PEERS_PER_QUERY])
+        peers.update(peer for peer, in con.execute(f"SELECT DISTINCT `{COL_PEER_UID}` FROM {TABLE_NAME}{where}", params))
+    return peers
+
+def _export_friends_grouped(con, config, tasks):
+    """
+    一次查询取出 tasks 中所有好友的消息，按会话对象分组后逐个导出；好友多于 _MAX_PEERS_PER_QUERY 个时分批查询。
+    分组按会话对象排序，与 tasks 的顺序不同，各好友打印的内容先暂存，按 tasks 的顺序依次产出。
+    """
+    for start in range(0, len(tasks), _MAX_PEERS_PER_QUERY):
+        chunk = tasks[start:start + _MAX_PEERS_PER_QUERY]
+        where, params = _peers_where(config, [task[0] for task in chunk])
+        query = f"SELECT `{COL_PEER_UID}`, `{COL_TIMESTAMP}`, `{COL_SENDER_UID}`, `{COL_MSG_CONTENT}` FROM {TABLE_NAME}{where} ORDER BY `{COL_PEER_UID}`, `{COL_TIMESTAMP}` ASC"
+
+        task_of = {task[0]: task for task in chunk}
+        groups = itertools.groupby(con.execute(query, params), key=itemgetter(0))
+        outputs = {}
+        for task in chunk:
+            while task[0] not in outputs:
+                group = next(groups, None)
+                if group is None: break
+                peer, peer_rows = group
+                outputs[peer] = _export_friend_captured(con, config, task_of[peer], (row[1:] for row in peer_rows))
+            # 查询结果中没有的好友在此导出，打印无聊天记录
+            yield outputs.pop(task[0], None) or _export_friend_captured(con, config, task, ())
+
+def _clear_reply_caches():
+    """清空引用缓存。缓存只以时间戳为键，单独导出时须限定在一个会话内，免得引用到其他好友同一秒的消息。"""
+    MESSAGE_CONTENT_CACHE.clear()
+    SALVAGE_CACHE.clear()
+
+def _export_friends(con, config, batches, total, jobs):
+    """
+    依次导出各批好友，batches 为 [(输出目录, 提示文字, [uid, ...]), ...]。
+    好友多于一个时：会话对象列没有索引则一次查询全部好友的消息再分组，免得每个好友都扫描全表；
+    有索引则先一次查出哪些好友有消息，没有消息的好友不再单独查询，
+    其余好友在可以 fork 时改用按好友划分的进程池，此时不再使用解析进程池。
+    """
+    global _FRIEND_CONFIG, _DECODE_POOL
+    tasks, index = [], 0
+    for out_dir, _, uids in batches:
+        for uid in uids:
+            index += 1
+            tasks.append((uid, out_dir, index, total))
+
+    pool = results = None
+    active = None # 有消息的好友，为 None 时不预先判断
+    if len(tasks) > 1 and not _has_leading_index(con, TABLE_NAME, COL_PEER_UID):
+        results = _export_friends_grouped(con, config, tasks)
+    elif len(tasks) > 1:
+        active = _peers_with_messages(con, config, [task[0] for task in tasks])
+        active_tasks = [task for task in tasks if task[0] in active]
+    if active is not None and jobs > 1 and len(active_tasks) > 1:
+        if _DECODE_POOL is not None:
+            _DECODE_POOL.shutdown()
+            _DECODE_POOL = None
+        _FRIEND_CONFIG = config
+        # 文件头要用到的数据库哈希先在父进程算好，子进程经 fork 继承 _SHA256_CACHE，不必各自重新读一遍数据库
+        if config['export_config'].get('add_file_header', False):
+            _calculate_sha256(DB_PATH)
+            _calculate_sha256(PROFILE_DB_PATH)
+        try:
+            pool = ProcessPoolExecutor(min(jobs, len(active_tasks)), mp_context=multiprocessing.get_context("fork"), initializer=_init_friend_worker)
+            results = pool.map(_export_friend_task, active_tasks)
+        except (ImportError, NotImplementedError, OSError, ValueError):
+            pool = results = None
+
+    try:
+        task_iter = iter(tasks)
+        for out_dir, title, uids in batches:
+            print(title)
+            for _ in uids:
+                uid, out_dir, index, total = next(task_iter)
+                if active is not None and uid not in active: # 不必查询，直接提示无聊天记录
+                    export_one_on_one(con, uid, config, {'type': 'individual', 'friend_uid': uid}, out_dir, index, total, ())
+                elif results is not None:
+                    print(next(results), end="")
+                else:
+                    _clear_reply_caches()
+                    export_one_on_one(con, uid, config, {'type': 'individual', 'friend_uid': uid}, out_dir, index, total)
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+        _FRIEND_CONFIG = None
+
+# --- 按消息类型分派的处理函数 ---
+# 统一签名 (seg, ctx)，ctx 为 (profile_mgr, name_style, name_format, export_config, is_timeline)
+
+def _msg_text(seg: dict, ctx: tuple) -> str:
+    """纯文本"""
+    return _b2s_san(seg, PB_TEXT_CONTENT)
+
+def _msg_reply(seg: dict, ctx: tuple) -> str:
+    """引用消息"""
+    profile_mgr, name_style, name_format, export_config, is_timeline = ctx
+    get = seg.get
+    ts = get(PB_REPLY_ORIGIN_TS)
+    origin_content = ""
+
+    # 优先从内容缓存中获取最准确的原文
+    if ts in MESSAGE_CONTENT_CACHE:
+        origin_content = MESSAGE_CONTENT_CACHE[ts]
+    # 如果内容缓存没有，再尝试从“抢救缓存”获取
+    elif ts in SALVAGE_CACHE:
+        origin_content = _sanitize_newlines(SALVAGE_CACHE[ts])
+    # 如果都没有，才回退到解析引用自带的摘要
+    else:
+        origin_content = _b2s_san(seg, PB_REPLY_ORIGIN_SUMMARY_TEXT)
+        if not origin_content:
+            # 如果摘要为空，尝试解析原始消息对象
+            origin_obj_list = get(PB_REPLY_ORIGIN_OBJ)
+            if origin_obj_list:
+                # 即使只有一个对象，也可能被包裹在列表中
+                origin_obj_list = origin_obj_list if isinstance(origin_obj_list, list) else [origin_obj_list]
+                origin_content_parts = [_parse_single_segment(o, export_config) for o in origin_obj_list]
+                origin_content = " ".join(filter(None, origin_content_parts))
+
+    s_uid = get(PB_REPLY_ORIGIN_SENDER_UID, b"").decode("utf-8")
+    sender = profile_mgr.get_display_name(get_placeholder(s_uid), name_style, name_format)
+
+    if is_timeline:
+        r_uid = get(PB_REPLY_ORIGIN_RECEIVER_UID, b"").decode("utf-8")
+        receiver = profile_mgr.get_display_name(get_placeholder(r_uid), name_style, name_format)
+        return f"[引用->{format_timestamp(ts)} {sender} -> {receiver}: {origin_content}]"
+    return f"[引用->{format_timestamp(ts)} {sender}: {origin_content}]"
+
+def _msg_call(seg: dict, ctx: tuple) -> str:
+    """通话"""
+    status = _b2s(seg, PB_CALL_STATUS)
+    call_type = seg.get(PB_CALL_TYPE)
+    call_type = "语音通话" if call_type == 1 else "视频通话" if call_type == 2 else "通话"
+    return f"[{call_type}] {status}"
+
+def _msg_voice(seg: dict, ctx: tuple) -> str:
+    """语音"""
+    text = _b2s_san(seg, PB_VOICE_TO_TEXT)
+    if text and ctx[3].get('show_voice_to_text'):
+        return f"[语音] 转文字：{text}"
+    return "[语音]"
+
+def _msg_gray_tip(seg: dict, ctx: tuple):
+    """灰字提示"""
+    profile_mgr, name_style, name_format, export_config, _ = ctx
+    return decode_gray_tip(seg, profile_mgr, name_style, name_format, export_config)
+
+def _msg_ark(seg: dict, ctx: tuple):
+    """Ark卡片"""
+    return decode_ark_message(seg)
+
+def _msg_segment(seg: dict, ctx: tuple) -> str:
+    """其他已知类型，交给消息元素解析"""
+    return _SEGMENT_HANDLERS.get(seg.get(PB_MSG_TYPE), _seg_default)(seg, ctx[3])
+
+# 消息类型ID -> 处理函数；不在 MSG_TYPE_MAP 中的类型不登记，直接跳过
+_MESSAGE_HANDLERS = dict.fromkeys(MSG_TYPE_MAP, _msg_segment)
+_MESSAGE_HANDLERS.update({1: _msg_text, 4: _msg_voice, 7: _msg_reply, 8: _msg_gray_tip, 10: _msg_ark, 21: _msg_call})
+
+def decode_message_content(content, timestamp, profile_mgr, name_style, name_format, export_config, is_timeline=False, decoded=None) -> list or None:
     """
     【核心消息解析函数】负责将原始字节流解码为可读的消息部分列表。
     :param is_timeline: 标志位，用于决定引用消息的格式。
+    :param decoded: 已由进程池解析好的Protobuf字典，为 None 时在此解析。
     """
     if not content: return None
+    cached = PARTS_CACHE.get(content)
+    if cached is not None:
+        PARTS_CACHE.move_to_end(content)
+        return cached
     try:
-        decoded, _ = blackboxprotobuf.decode_message(content)
+        if decoded is None:
+            if _lacks_container(content): return ["[结构错误: 未找到消息容器]"]
+            decoded = _decode_protobuf(content)
         segments_data = decoded.get(PB_MSG_CONTAINER)
         if segments_data is None: return ["[结构错误: 未找到消息容器]"]
         segments = segments_data if isinstance(segments_data, list) else [segments_data]
+        # 各消息处理函数共用的上下文
+        ctx = (profile_mgr, name_style, name_format, export_config, is_timeline)
         parts = []
+        cacheable = True
         for seg in segments:
             if not isinstance(seg, dict): continue
-            msg_type = seg.get(PB_MSG_TYPE)
-            part = None
-            if msg_type not in MSG_TYPE_MAP: continue
-            
-            if msg_type == 1:
-                text = seg.get(PB_TEXT_CONTENT, b"").decode("utf-8", "ignore")
-                part = _sanitize_newlines(text)
-            elif msg_type == 7: # 引用消息
-                ts = seg.get(PB_REPLY_ORIGIN_TS)
-                origin_content = ""
-                
-                # 优先从内容缓存中获取最准确的原文
-                if ts in MESSAGE_CONTENT_CACHE:
-                    origin_content = MESSAGE_CONTENT_CACHE[ts]
-                # 如果内容缓存没有，再尝试从“抢救缓存”获取
-                elif ts in SALVAGE_CACHE:
-                    origin_content = _sanitize_newlines(SALVAGE_CACHE[ts])
-                # 如果都没有，才回退到解析引用自带的摘要
-                else:
-                    raw_origin_content = seg.get(PB_REPLY_ORIGIN_SUMMARY_TEXT, b"").decode("utf-8", "ignore")
-                    origin_content = _sanitize_newlines(raw_origin_content)
-                    if not origin_content:
-                        # 如果摘要为空，尝试解析原始消息对象
-                        origin_obj_list = seg.get(PB_REPLY_ORIGIN_OBJ)
-                        if origin_obj_list:
-                             # 即使只有一个对象，也可能被包裹在列表中
-                            origin_obj_list = origin_obj_list if isinstance(origin_obj_list, list) else [origin_obj_list]
-                            origin_content_parts = [_parse_single_segment(o, export_config) for o in origin_obj_list]
-                            origin_content = " ".join(filter(None, origin_content_parts))
-
-                s_uid = seg.get(PB_REPLY_ORIGIN_SENDER_UID, b"").decode("utf-8")
-                sender = profile_mgr.get_display_name(get_placeholder(s_uid), name_style, name_format)
-
-                if is_timeline:
-                    r_uid = seg.get(PB_REPLY_ORIGIN_RECEIVER_UID, b"").decode("utf-8")
-                    receiver = profile_mgr.get_display_name(get_placeholder(r_uid), name_style, name_format)
-                    part = f"[引用->{format_timestamp(ts)} {sender} -> {receiver}: {origin_content}]"
-                else:
-                    part = f"[引用->{format_timestamp(ts)} {sender}: {origin_content}]"
-
-            elif msg_type == 21: # 通话
-                status = seg.get(PB_CALL_STATUS, b"").decode("utf-8", "ignore")
-                call_type = "语音通话" if seg.get(PB_CALL_TYPE) == 1 else "视频通话" if seg.get(PB_CALL_TYPE) == 2 else "通话"
-                part = f"[{call_type}] {status}"
-            elif msg_type == 4: # 语音
-                text_raw = seg.get(PB_VOICE_TO_TEXT, b"").decode("utf-8", "ignore")
-                if text_raw and export_config.get('show_voice_to_text'):
-                    text = _sanitize_newlines(text_raw)
-                    part = f"[语音] 转文字：{text}"
-                else:
-                    part = "[语音]"
-            elif msg_type == 8: part = decode_gray_tip(seg, profile_mgr, name_style, name_format, export_config)
-            elif msg_type == 10: part = decode_ark_message(seg)
-            else: part = _parse_single_segment(seg, export_config)
+            handler = _MESSAGE_HANDLERS.get(seg.get(PB_MSG_TYPE))
+            if handler is None: continue
+            if handler is _msg_reply: cacheable = False
+            part = handler(seg, ctx)
             if part: parts.append(part)
+        if cacheable and parts: PARTS_CACHE[content] = parts
         return parts or None
     except Exception:
         salvaged = None
         try:
-            match = re.search(r"(\[[^\]]{1,10}\])", content.decode("utf-8", "ignore"))
+            match = _SALVAGE_TAG_RE.search(content.decode("utf-8", "ignore"))
             if match: salvaged = match.group(1)
         except Exception: pass
         if not salvaged: salvaged = _extract_readable_text(content)
@@ -791,6 +1251,22 @@ def decode_message_content(content, timestamp, profile_mgr, name_style, name_for
         SALVAGE_CACHE[timestamp] = b64
         return [b64]
 
+# 文件头中"用户标识"一项的说明文字
+_NAME_STYLE_TEXT = {'default': "昵称/备注", 'nickname': "昵称", 'qq': "QQ号码", 'uid': "UID", 'custom': "组合标识"}
+
+@functools.lru_cache(maxsize=None)
+def _header_hint_text(show_recall, show_poke, show_voice_to_text):
+    """文件头的提示文字。只取决于导出配置，逐个好友导出时不必每个文件重新拼接。"""
+    included_features = []
+    if show_recall: included_features.append("撤回提示")
+    if show_poke: included_features.append("拍一拍/戳一戳")
+    if show_voice_to_text: included_features.append("语音转文字")
+    hint_text = "此文件由脚本自动生成。记录包含文本、图片、引用"
+    if included_features:
+        hint_text += f"、{'、'.join(included_features)}"
+    hint_text += "等消息。部分Ark卡片、系统消息和未知类型的消息可能被简化或忽略，旨在尽可能还原原始对话顺序和内容。"
+    return hint_text
+
 def _generate_text_header(config: dict, rows: list, scope_info: dict) -> str:
     """根据导出配置和范围，动态生成用于TXT/MD的文件头字符串"""
     if not config['export_config'].get('add_file_header', False) or not rows:
@@ -804,17 +1280,15 @@ def _generate_text_header(config: dict, rows: list, scope_info: dict) -> str:
     start_time = format_timestamp(rows[0][0])
     end_time = format_timestamp(rows[-1][0])
 
-    my_info = profile_mgr.all_users.get(profile_mgr.my_uid, {})
-    master_name = my_info.get('nickname', '未知')
-    master_qq = my_info.get('qq', '未知')
+    master_name = profile_mgr.nickname.get(profile_mgr.my_uid, '未知')
+    master_qq = profile_mgr.qq.get(profile_mgr.my_uid, '未知')
     
     scope_text = "未知范围"
     scope_type = scope_info.get('type')
     if scope_type == 'individual':
         friend_uid = scope_info['friend_uid']
-        friend_info = profile_mgr.all_users.get(friend_uid, {})
-        friend_nick = friend_info.get('nickname', friend_uid)
-        friend_remark = friend_info.get('remark')
+        friend_nick = profile_mgr.nickname.get(friend_uid, friend_uid)
+        friend_remark = profile_mgr.remark.get(friend_uid)
         remark_str = f" ({friend_remark})" if friend_remark else ""
         scope_text = f"{master_name} 与 {friend_nick}{remark_str} 的聊天"
     elif scope_type == 'timeline':
@@ -828,24 +1302,16 @@ def _generate_text_header(config: dict, rows: list, scope_info: dict) -> str:
             scope_text = f'分组"{gname}" ({count}人)'
         elif selection_mode == 'selected_friends':
             uids = scope_info['details']['uids']
-            nicks = [profile_mgr.all_users.get(uid, {}).get('nickname', uid) for uid in uids]
+            nicks = [profile_mgr.nickname.get(uid, uid) for uid in uids]
             if len(nicks) <= 5:
                 scope_text = "、".join(nicks)
             else:
                 scope_text = f'{"、".join(nicks[:5])} 等{len(nicks)}人'
 
-    style_map = {'default': "昵称/备注", 'nickname': "昵称", 'qq': "QQ号码", 'uid': "UID", 'custom': "组合标识"}
-    identifier_style_text = style_map.get(config['name_style'], "未知")
+    identifier_style_text = _NAME_STYLE_TEXT.get(config['name_style'], "未知")
 
-    included_features = []
     cfg = config['export_config']
-    if cfg.get('show_recall'): included_features.append("撤回提示")
-    if cfg.get('show_poke'): included_features.append("拍一拍/戳一戳")
-    if cfg.get('show_voice_to_text'): included_features.append("语音转文字")
-    hint_text = "此文件由脚本自动生成。记录包含文本、图片、引用"
-    if included_features:
-        hint_text += f"、{'、'.join(included_features)}"
-    hint_text += "等消息。部分Ark卡片、系统消息和未知类型的消息可能被简化或忽略，旨在尽可能还原原始对话顺序和内容。"
+    hint_text = _header_hint_text(bool(cfg.get('show_recall')), bool(cfg.get('show_poke')), bool(cfg.get('show_voice_to_text')))
 
     header = (
         "QQ 聊天记录归档\n\n"
@@ -863,6 +1329,13 @@ def _generate_text_header(config: dict, rows: list, scope_info: dict) -> str:
     )
     return header
 
+def _safe_escape(value):
+    """转义HTML特殊字符，供文件头和正文共用。"""
+    # 确保所有数据在 escape 前都是字符串，修复 `AttributeError`
+    # 使用 unescape 防止双重转义，修正 ✨&gt;猫猫&lt;✨ 这类问题；不含 & 时无需反转义
+    value = str(value)
+    return html.escape(html.unescape(value) if "&" in value else value)
+
 def _generate_html_header(config: dict, rows: list, scope_info: dict) -> str:
     """根据导出配置和范围，动态生成文件头的HTML字符串"""
     if not config['export_config'].get('add_file_header', False) or not rows:
@@ -870,30 +1343,23 @@ def _generate_html_header(config: dict, rows: list, scope_info: dict) -> str:
         
     profile_mgr = config['profile_mgr']
     
-    # 修复 `AttributeError` 的关键：确保所有数据在 escape 前都是字符串
-    # 使用 unescape 防止双重转义，修正 ✨&gt;猫猫&lt;✨ 这类问题
-    def safe_escape(value):
-        return html.escape(html.unescape(str(value)))
-
     msg_db_hash = _calculate_sha256(DB_PATH)
     profile_db_hash = _calculate_sha256(PROFILE_DB_PATH)
     gen_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     start_time = format_timestamp(rows[0][0])
     end_time = format_timestamp(rows[-1][0])
 
-    my_info = profile_mgr.all_users.get(profile_mgr.my_uid, {})
-    master_name = my_info.get('nickname', '未知')
-    master_qq = my_info.get('qq', '未知')
+    master_name = profile_mgr.nickname.get(profile_mgr.my_uid, '未知')
+    master_qq = profile_mgr.qq.get(profile_mgr.my_uid, '未知')
     
     scope_text = "未知范围"
     scope_type = scope_info.get('type')
     if scope_type == 'individual':
         friend_uid = scope_info['friend_uid']
-        friend_info = profile_mgr.all_users.get(friend_uid, {})
-        friend_nick = friend_info.get('nickname', friend_uid)
-        friend_remark = friend_info.get('remark')
-        remark_str = f" ({safe_escape(friend_remark)})" if friend_remark else ""
-        scope_text = f"{safe_escape(master_name)} 与 {safe_escape(friend_nick)}{remark_str} 的聊天"
+        friend_nick = profile_mgr.nickname.get(friend_uid, friend_uid)
+        friend_remark = profile_mgr.remark.get(friend_uid)
+        remark_str = f" ({_safe_escape(friend_remark)})" if friend_remark else ""
+        scope_text = f"{_safe_escape(master_name)} 与 {_safe_escape(friend_nick)}{remark_str} 的聊天"
     elif scope_type == 'timeline':
         selection_mode = scope_info['selection_mode']
         if selection_mode in ['all_friends', 'all_groups']:
@@ -902,27 +1368,19 @@ def _generate_html_header(config: dict, rows: list, scope_info: dict) -> str:
             gid = scope_info['details']['gid']
             gname = profile_mgr.group_info.get(gid, f"分组_{gid}")
             count = scope_info['details']['count']
-            scope_text = f'分组"{safe_escape(gname)}" ({count}人)'
+            scope_text = f'分组"{_safe_escape(gname)}" ({count}人)'
         elif selection_mode == 'selected_friends':
             uids = scope_info['details']['uids']
-            nicks = [safe_escape(profile_mgr.all_users.get(uid, {}).get('nickname', uid)) for uid in uids]
+            nicks = [_safe_escape(profile_mgr.nickname.get(uid, uid)) for uid in uids]
             if len(nicks) <= 5:
                 scope_text = "、".join(nicks)
             else:
                 scope_text = f'{"、".join(nicks[:5])} 等{len(nicks)}人'
 
-    style_map = {'default': "昵称/备注", 'nickname': "昵称", 'qq': "QQ号码", 'uid': "UID", 'custom': "组合标识"}
-    identifier_style_text = style_map.get(config['name_style'], "未知")
+    identifier_style_text = _NAME_STYLE_TEXT.get(config['name_style'], "未知")
 
-    included_features = []
     cfg = config['export_config']
-    if cfg.get('show_recall'): included_features.append("撤回提示")
-    if cfg.get('show_poke'): included_features.append("拍一拍/戳一戳")
-    if cfg.get('show_voice_to_text'): included_features.append("语音转文字")
-    hint_text = "此文件由脚本自动生成。记录包含文本、图片、引用"
-    if included_features:
-        hint_text += f"、{'、'.join(included_features)}"
-    hint_text += "等消息。部分Ark卡片、系统消息和未知类型的消息可能被简化或忽略，旨在尽可能还原原始对话顺序和内容。"
+    hint_text = _header_hint_text(bool(cfg.get('show_recall')), bool(cfg.get('show_poke')), bool(cfg.get('show_voice_to_text')))
 
     # 生成更具结构化的HTML文件头
     header_html = (
@@ -939,7 +1397,7 @@ def _generate_html_header(config: dict, rows: list, scope_info: dict) -> str:
         f'<p><strong>记录结束时间:</strong> {end_time}</p>\n'
         '</div>\n'
         '<div class="header-group scope-info">\n'
-        f'<p><strong>主人账号:</strong> {safe_escape(master_name)} ({safe_escape(master_qq)})</p>\n'
+        f'<p><strong>主人账号:</strong> {_safe_escape(master_name)} ({_safe_escape(master_qq)})</p>\n'
         f'<p><strong>好友范围:</strong> {scope_text}</p>\n'
         f'<p><strong>用户标识:</strong> {identifier_style_text}</p>\n'
         '</div>\n'
@@ -1085,7 +1543,7 @@ def manage_export_config(path_title, config_mgr):
             config_mgr.save_config()
             break
         
-        selected_keys = re.split(r'[\s,]+', choice_str)
+        selected_keys = _CHOICE_SPLIT_RE.split(choice_str)
         toggled = False
 
         for key in selected_keys:
@@ -1145,10 +1603,9 @@ def select_friends(profile_mgr, config_mgr, path_title):
     groups_with_friends = {}
     
     # 填充好友分组
-    for uid, info in profile_mgr.all_users.items():
-        if uid == profile_mgr.my_uid or not info.get('is_friend'):
+    for uid, gid in profile_mgr.group_id.items():
+        if uid == profile_mgr.my_uid or uid not in profile_mgr.friend_uids:
             continue
-        gid = info['group_id']
         if gid not in groups_with_friends:
             groups_with_friends[gid] = []
         groups_with_friends[gid].append(uid)
@@ -1156,22 +1613,24 @@ def select_friends(profile_mgr, config_mgr, path_title):
     # 如果开启了非好友导出，添加特殊分组
     if config_mgr.config.get('export_non_friends', True) and profile_mgr.non_friend_uids:
         groups_with_friends[-2] = profile_mgr.non_friend_uids # 使用-2作为非好友的特殊ID
+
+    # 分组在菜单期间不会变化，只需整理一次
+    display_groups = {}
+    # 确保分组存在才显示
+    for gid, uids in groups_with_friends.items():
+        if gid == -2:
+            name = "[非好友/临时会话]"
+        else:
+            name = profile_mgr.group_info.get(gid, f"分组_{gid}")
+        display_groups[gid] = {'name': name, 'uids': uids}
+
+    sorted_display_groups = sorted(display_groups.items(), key=lambda i: i[0])
+    choices = {str(i+1): gid for i, (gid, data) in enumerate(sorted_display_groups)}
+    qq_col, nickname_col, remark_col = profile_mgr.qq, profile_mgr.nickname, profile_mgr.remark
         
     while True:
         print(f"\n--- {path_title} ---")
         
-        display_groups = {}
-        # 确保分组存在才显示
-        for gid, uids in groups_with_friends.items():
-            if gid == -2:
-                name = "[非好友/临时会话]"
-            else:
-                name = profile_mgr.group_info.get(gid, f"分组_{gid}")
-            display_groups[gid] = {'name': name, 'uids': uids}
-
-        sorted_display_groups = sorted(display_groups.items(), key=lambda i: i[0])
-        
-        choices = {str(i+1): gid for i, (gid, data) in enumerate(sorted_display_groups)}
         for i, (gid, data) in enumerate(sorted_display_groups):
             print(f"  {i+1}. {data['name']} ({len(data['uids'])}人)")
             
@@ -1188,7 +1647,7 @@ def select_friends(profile_mgr, config_mgr, path_title):
         elif choice in choices:
             selected_gid = choices[choice]
             gids_to_show.append(selected_gid)
-            group_name_for_title = display_groups.get(selected_gid, {}).get('name', '')
+            group_name_for_title = display_groups[selected_gid]['name']
         else:
             print("  -> 无效输入，请重试。")
             continue
@@ -1198,7 +1657,7 @@ def select_friends(profile_mgr, config_mgr, path_title):
         i = 1
         for gid in gids_to_show:
             if choice == 'a':
-                current_group_name = display_groups.get(gid, {}).get('name', f"分组_{gid}")
+                current_group_name = display_groups[gid]['name']
                 print(f"\n--- {current_group_name} ---")
             
             if not groups_with_friends.get(gid):
@@ -1206,9 +1665,9 @@ def select_friends(profile_mgr, config_mgr, path_title):
                 continue
             
             for uid in groups_with_friends[gid]:
-                info = profile_mgr.all_users[uid]
-                remark = f" (备注: {info['remark']})" if info['remark'] else ""
-                display = f"{info['nickname'] or info['qq']}{remark} (QQ: {info['qq']})"
+                qq, remark = qq_col[uid], remark_col[uid]
+                remark = f" (备注: {remark})" if remark else ""
+                display = f"{nickname_col[uid] or qq}{remark} (QQ: {qq})"
                 print(f"  {i}. {display}")
                 selectable[str(i)] = uid
                 i += 1
@@ -1218,7 +1677,7 @@ def select_friends(profile_mgr, config_mgr, path_title):
             continue
             
         choices_str = input("请输入用户序号 (可多选，用空格或逗号分隔): ").strip()
-        selected = [selectable[c] for c in re.split(r'[\s,]+', choices_str) if c in selectable]
+        selected = [selectable[c] for c in _CHOICE_SPLIT_RE.split(choices_str) if c in selectable]
         if selected: return list(set(selected))
         continue
 
@@ -1227,9 +1686,8 @@ def select_group(profile_mgr, config_mgr, path_title):
     print(f"\n--- {path_title} ---")
     
     friends_by_group = {}
-    for uid, info in profile_mgr.all_users.items():
-        if uid != profile_mgr.my_uid and info.get('is_friend'):
-            gid = info.get('group_id')
+    for uid, gid in profile_mgr.group_id.items():
+        if uid != profile_mgr.my_uid and uid in profile_mgr.friend_uids:
             if gid not in friends_by_group: friends_by_group[gid] = []
             friends_by_group[gid].append(uid)
     
@@ -1262,104 +1720,145 @@ def select_group(profile_mgr, config_mgr, path_title):
         return None
 
 # --- 导出执行逻辑 ---
+_WRITE_BATCH_LINES = 512 # 文本与Markdown写入时每批合并的行数
+_ESCAPE_CACHE_MAX_LEN = 16 # HTML中只缓存不超过此长度的正文转义结果，如 [图片]、表情和简短回复
+
+class _NameCache(dict):
+    """在一次写入过程中按原始UID缓存显示名称 (空值按占位符处理)。"""
+    def __init__(self, profile_mgr, name_style, name_format):
+        super().__init__()
+        self.profile_mgr, self.name_style, self.name_format = profile_mgr, name_style, name_format
+
+    def __missing__(self, uid):
+        # 驻留后，写入循环里比较发送者时相同名称是同一个对象，比较只需看指针
+        name = self[uid] = _intern(self.profile_mgr.get_display_name(get_placeholder(uid), self.name_style, self.name_format))
+        return name
+
 def _write_txt(f, rows, profile_mgr, config):
     """将聊天记录写入纯文本文件"""
     name_style = config.get('name_style', 'default')
     name_format = config.get('name_format', '')
+    export_config, is_timeline = config['export_config'], config['is_timeline']
+    names = _NameCache(profile_mgr, name_style, name_format)
     count = 0
+    last_ts = None
+    buf = [] # 攒够一批行再一次写入，减少逐行调用 f.write
+    write = buf.append
     for row in rows:
-        ts, s_uid, p_uid, content = row
-        parts = decode_message_content(content, ts, profile_mgr, name_style, name_format, config['export_config'], config['is_timeline'])
-        if not parts: continue
+        ts, s_uid, p_uid, content, decoded, parts = row
+        if parts is None:
+            parts = decode_message_content(content, ts, profile_mgr, name_style, name_format, export_config, is_timeline, decoded)
+            if not parts: continue
         
-        is_reply = isinstance(parts[0], str) and parts[0].startswith('[引用->')
-        text = " ".join(str(p) for p in parts if not isinstance(p, dict))
+        first = parts[0]
+        is_str = type(first) is str
+        is_reply = is_str and first.startswith('[引用->')
+        # 大多数消息只有一段文本，直接使用，不必拼接
+        if is_str and len(parts) == 1: text = first
+        else: text = " ".join([str(p) for p in parts if not isinstance(p, dict)])
         
         if not is_reply:
             MESSAGE_CONTENT_CACHE[ts] = text
         else:
-            pattern = r'\[引用->(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}) (.*)\]'
-            replacement = r'[引用-> [\1] \2 <-]'
-            text = re.sub(pattern, replacement, text, count=1)
+            text = _QUOTE_REWRITE_RE.sub(r'[引用-> [\1] \2 <-]', text, count=1)
 
-        time = format_timestamp(ts)
-        first = parts[0]
-        if isinstance(first, dict) and first.get("type") == "interactive_tip":
+        if ts != last_ts: # 同一秒的相邻消息共用格式化结果
+            time = format_timestamp(ts)
+            last_ts = ts
+        if not is_str and isinstance(first, dict) and first.get("type") == "interactive_tip":
             body = f"{first['actor']} {first['verb']} {first['target']}{first['suffix']}"
             line = f"[{time}] [系统提示]: {body}\n"
         else:
-            sender = profile_mgr.get_display_name(get_placeholder(s_uid), name_style, name_format)
+            sender = names[s_uid]
             if sender == "N/A": sender = "[系统提示]"
-            if config['is_timeline']:
+            if is_timeline:
                 if get_placeholder(s_uid) == get_placeholder(p_uid): p_uid = profile_mgr.my_uid
-                receiver = profile_mgr.get_display_name(get_placeholder(p_uid), name_style, name_format)
+                receiver = names[p_uid]
                 line = f"[{time}] {sender} -> {receiver}: {text}\n"
             else: line = f"[{time}] {sender}: {text}\n"
-        f.write(line)
+        write(line)
         count += 1
+        if len(buf) >= _WRITE_BATCH_LINES:
+            f.write("".join(buf))
+            buf.clear()
+    f.write("".join(buf))
     return count
 
 def _write_md(f, rows, profile_mgr, config):
     """将聊天记录写入Markdown文件"""
     name_style = config.get('name_style', 'default')
     name_format = config.get('name_format', '')
+    export_config, is_timeline = config['export_config'], config['is_timeline']
+    names = _NameCache(profile_mgr, name_style, name_format)
     count = 0
     last_date = None
     last_sender_key = None
     last_element_was_quote = False # 状态追踪变量
+    last_ts = None
+    buf = [] # 攒够一批行再一次写入，减少逐行调用 f.write
+    write = buf.append
     
     for row in rows:
-        ts, s_uid, p_uid, content = row
-        parts = decode_message_content(content, ts, profile_mgr, name_style, name_format, config['export_config'], config['is_timeline'])
-        if not parts: continue
+        ts, s_uid, p_uid, content, decoded, parts = row
+        if parts is None:
+            parts = decode_message_content(content, ts, profile_mgr, name_style, name_format, export_config, is_timeline, decoded)
+            if not parts: continue
         
-        dt_object = datetime.fromtimestamp(ts)
-        current_date = dt_object.strftime("%Y-%m-%d")
-        current_time = dt_object.strftime("%H:%M:%S")
+        # 消息按时间排序，同一秒的消息相邻，只在时间戳变化时格式化一次
+        if ts != last_ts:
+            stamp = datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M:%S")
+            current_date, current_time = sys.intern(stamp[:10]), stamp[11:]
+            last_ts = ts
 
-        sender_display = profile_mgr.get_display_name(get_placeholder(s_uid), name_style, name_format)
+        sender_display = names[s_uid]
         if sender_display == "N/A":
             sender_key = "[系统提示]"
-        elif config['is_timeline']:
+        elif is_timeline:
             if get_placeholder(s_uid) == get_placeholder(p_uid): p_uid = profile_mgr.my_uid
-            receiver_display = profile_mgr.get_display_name(get_placeholder(p_uid), name_style, name_format)
-            sender_key = f"{sender_display} -> {receiver_display}"
+            receiver_display = names[p_uid]
+            sender_key = sys.intern(f"{sender_display} -> {receiver_display}")
         else:
             sender_key = sender_display
 
         if current_date != last_date:
             if last_date is not None:
                 if not last_element_was_quote:
-                    f.write(f"\n")
-            f.write(f"# {current_date}\n")
+                    write(f"\n")
+            write(f"# {current_date}\n")
             last_date = current_date
             last_sender_key = None
             last_element_was_quote = False
         
         if sender_key != last_sender_key:
             if not last_element_was_quote:
-                f.write(f"\n")
-            f.write(f"### {sender_key}\n")
+                write(f"\n")
+            write(f"### {sender_key}\n")
             last_sender_key = sender_key
             last_element_was_quote = False
 
-        main_text_parts = []
-        quote_content = ""
-        is_reply = isinstance(parts[0], str) and parts[0].startswith('[引用->')
-        
-        if not is_reply and isinstance(parts[0], dict) and parts[0].get("type") == "interactive_tip":
-            tip = parts[0]
-            main_text_parts.append(f"{tip['actor']} {tip['verb']} {tip['target']}{tip['suffix']}")
+        first = parts[0]
+        # 常见情况：只有一段不含引用的文本，直接作为正文，不必逐段匹配引用
+        if len(parts) == 1 and type(first) is str and "[引用->" not in first:
+            main_text, quote_content, is_reply = first, "", False
         else:
-            for p in parts:
-                p_str = str(p)
-                match = re.search(r'\[引用->(.*)\]', p_str)
-                if match:
-                    quote_content = match.group(1)
-                else:
-                    main_text_parts.append(p_str)
+            main_text_parts = []
+            quote_content = ""
+            is_reply = isinstance(parts[0], str) and parts[0].startswith('[引用->')
+        
+            if not is_reply and isinstance(parts[0], dict) and parts[0].get("type") == "interactive_tip":
+                tip = parts[0]
+                main_text_parts.append(f"{tip['actor']} {tip['verb']} {tip['target']}{tip['suffix']}")
+            else:
+                for p in parts:
+                    p_str = str(p)
+                    # 只有含引用标记的段才需要正则提取
+                    match = _QUOTE_EXTRACT_RE.search(p_str) if "[引用->" in p_str else None
+                    if match:
+                        quote_content = match.group(1)
+                    else:
+                        main_text_parts.append(p_str)
         
-        main_text = " ".join(main_text_parts)
+            main_text = " ".join(main_text_parts)
         
         if not is_reply:
             MESSAGE_CONTENT_CACHE[ts] = main_text
@@ -1367,14 +1866,18 @@ def _write_md(f, rows, profile_mgr, config):
         if sender_key == "[系统提示]" and main_text.startswith('[') and main_text.endswith(']'):
                 main_text = main_text[1:-1]
 
-        f.write(f"* {current_time} {main_text}\n")
+        write(f"* {current_time} {main_text}\n")
         if quote_content:
-            f.write(f"  > {quote_content}\n\n")
+            write(f"  > {quote_content}\n\n")
             last_element_was_quote = True
         else:
             last_element_was_quote = False
         
         count += 1
+        if len(buf) >= _WRITE_BATCH_LINES:
+            f.write("".join(buf))
+            buf.clear()
+    f.write("".join(buf))
     return count
 
 def _write_html(f, rows, profile_mgr, config, scope_info):
@@ -1383,8 +1886,7 @@ def _write_html(f, rows, profile_mgr, config, scope_info):
     template_path = os.path.join(TEMPLATE_DIR_PATH, template_filename)
 
     try:
-        with open(template_path, 'r', encoding='utf-8') as tpl_f:
-            template_str = tpl_f.read()
+        pieces = _load_template_pieces(template_path)
     except FileNotFoundError:
         print(f"\n错误：HTML模板文件 '{template_path}' 未找到。请确保它存在于 '{TEMPLATE_DIR_PATH}' 文件夹中。")
         f.write(f"<h1>错误</h1><p>HTML模板文件 '{template_filename}' 未在 '{TEMPLATE_DIR_PATH}' 文件夹中找到。</p>")
@@ -1396,18 +1898,39 @@ def _write_html(f, rows, profile_mgr, config, scope_info):
 
     name_style = config.get('name_style', 'default')
     name_format = config.get('name_format', '')
+    export_config, is_timeline = config['export_config'], config['is_timeline']
+    names = _NameCache(profile_mgr, name_style, name_format)
+    escaped_senders = {} # 发送者不多但切换频繁，转义结果按发送者缓存
+    escaped_texts = {} # 简短的正文重复较多，转义结果同样缓存；长文本很少重复，不缓存
     
-    def safe_escape(value):
-        return html.escape(html.unescape(str(value)))
 
-    # 1. 生成文件头HTML
+    # 1. 生成文件头HTML；模板只有一个聊天内容占位符时先写出它之前的部分，主体直接写入文件
+    #    有多个占位符时主体先写入内存，最后填入每个占位符；没有占位符时丢弃主体
     header_html = _generate_html_header(config, rows, scope_info)
+    slot_count = pieces.count('{{chat_content}}')
+    if slot_count == 1:
+        slot = pieces.index('{{chat_content}}')
+        _write_template_pieces(f, pieces[:slot], header_html)
+        out = f
+    else:
+        out = io.StringIO() if slot_count else None
 
-    # 2. 生成聊天内容主体HTML
+    # 2. 生成聊天内容主体HTML，攒够一批就写入文件，各段之间以换行分隔
     content_html_parts = []
+    body_started = False
     last_date = None
     last_sender_key = None
+    last_ts = None
     
+    def flush_parts():
+        nonlocal body_started
+        if not content_html_parts: return
+        if out is not None:
+            if body_started: out.write('\n')
+            out.write('\n'.join(content_html_parts))
+        body_started = True
+        content_html_parts.clear()
+
     def close_open_tags():
         if last_sender_key is not None:
             content_html_parts.append('</div></div>') 
@@ -1415,21 +1938,24 @@ def _write_html(f, rows, profile_mgr, config, scope_info):
             content_html_parts.append('</div></details>')
 
     for row in rows:
-        ts, s_uid, p_uid, content = row
-        parts = decode_message_content(content, ts, profile_mgr, name_style, name_format, config['export_config'], config['is_timeline'])
-        if not parts: continue
+        ts, s_uid, p_uid, content, decoded, parts = row
+        if parts is None:
+            parts = decode_message_content(content, ts, profile_mgr, name_style, name_format, export_config, is_timeline, decoded)
+            if not parts: continue
         
-        dt_object = datetime.fromtimestamp(ts)
-        current_date = dt_object.strftime("%Y-%m-%d")
-        current_time = dt_object.strftime("%H:%M:%S")
+        # 消息按时间排序，同一秒的消息相邻，只在时间戳变化时格式化一次
+        if ts != last_ts:
+            stamp = datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M:%S")
+            current_date, current_time = sys.intern(stamp[:10]), stamp[11:]
+            last_ts = ts
 
-        sender_display = profile_mgr.get_display_name(get_placeholder(s_uid), name_style, name_format)
+        sender_display = names[s_uid]
         if sender_display == "N/A":
             sender_key = "[系统提示]"
-        elif config['is_timeline']:
+        elif is_timeline:
             if get_placeholder(s_uid) == get_placeholder(p_uid): p_uid = profile_mgr.my_uid
-            receiver_display = profile_mgr.get_display_name(get_placeholder(p_uid), name_style, name_format)
-            sender_key = f"{sender_display} -> {receiver_display}"
+            receiver_display = names[p_uid]
+            sender_key = sys.intern(f"{sender_display} -> {receiver_display}")
         else:
             sender_key = sender_display
 
@@ -1449,35 +1975,47 @@ def _write_html(f, rows, profile_mgr, config, scope_info):
                 content_html_parts.append('<div class="system-message-container"><div class="message-block">')
             else:
                 content_html_parts.append(f'<div class="sender-message-group {speaker_class}">')
-                content_html_parts.append(f'<div class="sender">{safe_escape(sender_key)}</div>')
+                escaped_sender = escaped_senders.get(sender_key)
+                if escaped_sender is None:
+                    escaped_sender = escaped_senders[sender_key] = _safe_escape(sender_key)
+                content_html_parts.append(f'<div class="sender">{escaped_sender}</div>')
                 content_html_parts.append('<div class="message-block">')
             last_sender_key = sender_key
 
-        main_text_parts = []
-        quote_content = ""
-        is_reply = isinstance(parts[0], str) and parts[0].startswith('[引用->')
-
-        if not is_reply and isinstance(parts[0], dict) and parts[0].get("type") == "interactive_tip":
-            tip = parts[0]
-            actor = safe_escape(tip['actor'])
-            verb = safe_escape(tip['verb'])
-            target = safe_escape(tip['target'])
-            suffix = safe_escape(tip['suffix'])
-            main_text_parts.append(f"{actor} {verb} {target}{suffix}")
+        first = parts[0]
+        # 常见情况：只有一段不含引用的文本，直接作为正文，不必逐段匹配引用
+        if len(parts) == 1 and type(first) is str and "[引用->" not in first:
+            main_text, quote_content, is_reply = first, "", False
         else:
-            for p in parts:
-                p_str = str(p)
-                match = re.search(r'\[引用->(.*)\]', p_str)
-                if match:
-                    quote_content = match.group(1)
-                else:
-                    main_text_parts.append(p_str)
+            main_text_parts = []
+            quote_content = ""
+            is_reply = isinstance(parts[0], str) and parts[0].startswith('[引用->')
+
+            if not is_reply and isinstance(parts[0], dict) and parts[0].get("type") == "interactive_tip":
+                tip = parts[0]
+                actor = _safe_escape(tip['actor'])
+                verb = _safe_escape(tip['verb'])
+                target = _safe_escape(tip['target'])
+                suffix = _safe_escape(tip['suffix'])
+                main_text_parts.append(f"{actor} {verb} {target}{suffix}")
+            else:
+                for p in parts:
+                    p_str = str(p)
+                    # 只有含引用标记的段才需要正则提取
+                    match = _QUOTE_EXTRACT_RE.search(p_str) if "[引用->" in p_str else None
+                    if match:
+                        quote_content = match.group(1)
+                    else:
+                        main_text_parts.append(p_str)
         
-        main_text = " ".join(main_text_parts)
+            main_text = " ".join(main_text_parts)
         if not is_reply:
             MESSAGE_CONTENT_CACHE[ts] = main_text
 
-        escaped_main_text = safe_escape(main_text).replace('[%\\n%]', '<br>')
+        escaped_main_text = escaped_texts.get(main_text)
+        if escaped_main_text is None:
+            escaped_main_text = _safe_escape(main_text).replace('[%\\n%]', '<br>')
+            if len(main_text) <= _ESCAPE_CACHE_MAX_LEN: escaped_texts[main_text] = escaped_main_text
         
         if sender_key == "[系统提示]":
              if escaped_main_text.startswith('[') and escaped_main_text.endswith(']'):
@@ -1487,29 +2025,83 @@ def _write_html(f, rows, profile_mgr, config, scope_info):
             content_html_parts.append(f'<div class="message-item"><span class="timestamp">{current_time}</span><span class="message-content">{escaped_main_text}</span></div>')
 
         if quote_content:
-            escaped_quote = safe_escape(quote_content).replace('[%\\n%]', '<br>')
+            escaped_quote = _safe_escape(quote_content).replace('[%\\n%]', '<br>')
             content_html_parts.append(f'<div class="reply-container"><blockquote>{escaped_quote}</blockquote></div>')
 
+        if len(content_html_parts) >= _WRITE_BATCH_LINES:
+            flush_parts()
+
     close_open_tags()
+    flush_parts()
     
-    final_html = template_str.replace('{{file_header}}', header_html)
-    final_html = final_html.replace('{{chat_content}}', '\n'.join(content_html_parts))
-
-    f.write(final_html)
+    # 3. 写出模板的其余部分
+    if slot_count == 1:
+        _write_template_pieces(f, pieces[slot + 1:], header_html)
+    else:
+        _write_template_pieces(f, pieces, header_html, out.getvalue() if out is not None else '')
     return len(rows)
 
+@functools.lru_cache(maxsize=None)
+def _load_template_pieces(template_path):
+    """读取HTML模板并按占位符切分，同一模板只读取一次，逐个好友导出时各文件共用。"""
+    with open(template_path, 'r', encoding='utf-8') as tpl_f:
+        return tuple(_TEMPLATE_SLOT_RE.split(tpl_f.read()))
+
+def _write_template_pieces(f, pieces, header_html, content_html=''):
+    """写出按占位符切分的模板片段，文件头占位符替换为 header_html，聊天内容占位符替换为 content_html。"""
+    for piece in pieces:
+        if piece == '{{file_header}}':
+            f.write(header_html)
+        elif piece == '{{chat_content}}':
+            f.write(content_html)
+        elif piece:
+            f.write(piece)
+
+def _open_output(path):
+    """打开聊天记录输出文件；路径以 .gz 结尾时直接写入gzip流，使用最快的压缩级别。"""
+    if path.endswith(".gz"):
+        return gzip.open(path, "wt", encoding="utf-8", compresslevel=1)
+    return open(path, "w", encoding="utf-8")
+
 def process_and_write(output_path, rows, profile_mgr, config, scope_info):
-    """将查询到的数据库行处理并写入文件，支持txt、md、html三种格式。如果有效消息为0，则不创建文件。"""
-    export_format = config['export_config'].get('export_format', 'md')
+    """
+    将查询到的数据库行处理并写入文件，支持txt、md、html三种格式。如果有效消息为0，则不创建文件。
+    rows 可以是游标等任意可迭代对象，按批取出预处理，只保留有效消息。
+    """
+    name_style, name_format = config['name_style'], config['name_format']
+    export_config, is_timeline = config['export_config'], config['is_timeline']
+    export_format = export_config.get('export_format', 'md')
     count = 0
+    PARTS_CACHE.clear()
     
-    # 预处理，检查是否有有效消息
-    valid_rows = [row for row in rows if decode_message_content(row[3], row[0], profile_mgr, config['name_style'], config['name_format'], config['export_config'], config.get('is_timeline', False))]
+    # 预处理，只保留有效消息，解析结果附在每行末尾: (ts, s_uid, p_uid, content, decoded, parts)
+    # 每批消息较多时先用进程池并行解析Protobuf，得到 decoded；
+    # 不含引用的结果已存入 PARTS_CACHE，与写入顺序无关，写入时直接使用；
+    # 含引用的消息要用到写入过程中才填充的 MESSAGE_CONTENT_CACHE，parts 记为 None，写入时再用 decoded 解析
+    # 处理当前一批之前先把下一批提交给进程池，子进程解析与主进程处理同时进行
+    valid_rows = []
+    rows = iter(rows)
+    batch = list(itertools.islice(rows, _PREFILTER_BATCH_ROWS))
+    pending = _predecode_rows(batch)
+    while batch:
+        next_batch = list(itertools.islice(rows, _PREFILTER_BATCH_ROWS))
+        next_pending = _predecode_rows(next_batch)
+        predecoded = pending or itertools.repeat(None)
+        for row, decoded in zip(batch, predecoded):
+            parts = decode_message_content(row[3], row[0], profile_mgr, name_style, name_format, export_config, is_timeline, decoded)
+            if not parts:
+                continue
+            # 已缓存的消息写入时用不到 decoded，不再保留，免得整段导出期间占着内存
+            if row[3] in PARTS_CACHE:
+                valid_rows.append((*row, None, parts))
+            else:
+                valid_rows.append((*row, decoded, None))
+        batch, pending = next_batch, next_pending
     
     if not valid_rows:
         return 0 # 没有有效消息，直接返回，不创建文件
 
-    with open(output_path, "w", encoding="utf-8") as f:
+    with _open_output(output_path) as f:
         if export_format == 'html':
             count = _write_html(f, valid_rows, profile_mgr, config, scope_info)
         else:
@@ -1527,7 +2119,8 @@ def process_and_write(output_path, rows, profile_mgr, config, scope_info):
 def export_timeline(db_con, config, target_uids, scope_info):
     """执行全局时间线导出。"""
     print("\n正在执行“全局时间线”导出...")
-    start_ts, end_ts, name_style, name_format, profile_mgr, run_timestamp, export_config = config.values()
+    start_ts, end_ts = config['start_ts'], config['end_ts']
+    profile_mgr, run_timestamp, export_config = config['profile_mgr'], config['run_timestamp'], config['export_config']
     
     query = f"SELECT `{COL_TIMESTAMP}`, `{COL_SENDER_UID}`, `{COL_PEER_UID}`, `{COL_MSG_CONTENT}` FROM {TABLE_NAME}"
     clauses = []
@@ -1552,63 +2145,81 @@ def export_timeline(db_con, config, target_uids, scope_info):
     
     cur = db_con.cursor()
     cur.execute(query, params)
-    rows = cur.fetchall()
-    if not rows:
+    # 只取出第一行判断是否有记录，其余行交给 process_and_write 直接从游标中读取
+    first_row = cur.fetchone()
+    if first_row is None:
         print("查询完成，但未能获取任何记录。")
         return
+    rows = itertools.chain((first_row,), cur)
         
     ext = f".{export_config.get('export_format', 'md')}"
     timeline_dir = os.path.join(OUTPUT_DIR, "Timeline")
-    os.makedirs(timeline_dir, exist_ok=True)
+    _ensure_dir(timeline_dir)
     filename = f"{_TIMELINE_FILENAME_BASE}{run_timestamp}{ext}"
+    if GZIP_OUTPUT: filename += ".gz"
     path = os.path.join(timeline_dir, filename)
     
-    process_config = config.copy()
-    process_config['is_timeline'] = True
-    count = process_and_write(path, rows, profile_mgr, process_config, scope_info)
+    # main 传入的配置已标明导出模式，其他调用方的配置才需要复制一份
+    if config.get('is_timeline') is not True: config = {**config, 'is_timeline': True}
+    count = process_and_write(path, rows, profile_mgr, config, scope_info)
     if count > 0:
         print(f"\n处理完成！共导出 {count} 条有效消息到 {path}")
     else:
         print("\n处理完成，但在指定范围内未发现可导出的有效消息。")
 
-def export_one_on_one(db_con, friend_uid, config, scope_info, out_dir=None, index=None, total=None):
-    """导出一个好友的一对一聊天记录。"""
-    start_ts, end_ts, name_style, name_format, profile_mgr, run_timestamp, export_config = config.values()
+@functools.lru_cache(maxsize=None)
+def _ensure_dir(path):
+    """创建输出目录。同一分组的好友共用目录，每个目录只需创建一次。"""
+    os.makedirs(path, exist_ok=True)
+
+@functools.lru_cache(maxsize=None)
+def _one_on_one_query(has_start, has_end):
+    """
+    单个好友的查询语句，参数全部以占位符传入。
+    逐个好友导出时语句文本保持不变，可以复用连接中已编译好的语句。
+    """
+    # 会话对象就是 friend_uid，不必逐行从数据库中读出
+    query = f"SELECT `{COL_TIMESTAMP}`, `{COL_SENDER_UID}`, `{COL_MSG_CONTENT}` FROM {TABLE_NAME}"
+    clauses = [f"`{COL_PEER_UID}` = ?"]
+    if has_start: clauses.append(f"`{COL_TIMESTAMP}` >= ?")
+    if has_end: clauses.append(f"`{COL_TIMESTAMP}` <= ?")
+    return query + f" WHERE {' AND '.join(clauses)} ORDER BY `{COL_TIMESTAMP}` ASC"
+
+def export_one_on_one(db_con, friend_uid, config, scope_info, out_dir=None, index=None, total=None, rows=None):
+    """
+    导出一个好友的一对一聊天记录。
+    :param rows: 已查询出的 (ts, s_uid, content) 行，为 None 时在此查询。
+    """
+    start_ts, end_ts = config['start_ts'], config['end_ts']
+    profile_mgr, run_timestamp, export_config = config['profile_mgr'], config['run_timestamp'], config['export_config']
     
-    friend_info = profile_mgr.all_users.get(friend_uid, {})
-    friend_nickname = friend_info.get('nickname', friend_uid)
-    friend_remark = friend_info.get('remark', '')
+    friend_nickname = profile_mgr.nickname.get(friend_uid, friend_uid)
+    friend_remark = profile_mgr.remark.get(friend_uid, '')
     friend_display_name = f"{friend_nickname or friend_uid}{f' (备注-{friend_remark})' if friend_remark else ''}"
     
     log_prefix = f"    ({index}/{total}) {friend_display_name}"
     
-    query = f"SELECT `{COL_TIMESTAMP}`, `{COL_SENDER_UID}`, `{COL_PEER_UID}`, `{COL_MSG_CONTENT}` FROM {TABLE_NAME}"
-    clauses = [f"`{COL_PEER_UID}` = ?"]
-    params = [friend_uid]
-
-    if start_ts:
-        clauses.append(f"`{COL_TIMESTAMP}` >= ?")
-        params.append(start_ts)
-    if end_ts:
-        clauses.append(f"`{COL_TIMESTAMP}` <= ?")
-        params.append(end_ts)
-    query += f" WHERE {' AND '.join(clauses)} ORDER BY `{COL_TIMESTAMP}` ASC"
-    
-    cur = db_con.cursor()
-    cur.execute(query, params)
-    rows = cur.fetchall()
-    if not rows:
+    if rows is None:
+        params = [friend_uid]
+        if start_ts: params.append(start_ts)
+        if end_ts: params.append(end_ts)
+        rows = db_con.cursor().execute(_one_on_one_query(bool(start_ts), bool(end_ts)), params)
+    rows = iter(rows)
+    first_row = next(rows, None)
+    if first_row is None:
         print(f"{log_prefix}... -> 指定时间内无聊天记录。")
         return
+    rows = ((ts, s_uid, friend_uid, content) for ts, s_uid, content in itertools.chain((first_row,), rows))
 
     output_dir = out_dir or os.path.join(OUTPUT_DIR, "Individual")
-    os.makedirs(output_dir, exist_ok=True)
+    _ensure_dir(output_dir)
     filename = profile_mgr.get_filename(friend_uid, run_timestamp, export_config.get('export_format', 'md'))
+    if GZIP_OUTPUT: filename += ".gz"
     path = os.path.join(output_dir, filename)
         
-    process_config = config.copy()
-    process_config['is_timeline'] = False
-    count = process_and_write(path, rows, profile_mgr, process_config, scope_info)
+    # main 传入的配置已标明导出模式，逐个好友导出时不必每次复制
+    if config.get('is_timeline') is not False: config = {**config, 'is_timeline': False}
+    count = process_and_write(path, rows, profile_mgr, config, scope_info)
     
     if count > 0:
         print(f"{log_prefix}... -> 共导出 {count} 条消息到 \"{filename}\"")
@@ -1623,30 +2234,26 @@ def export_user_list(profile_mgr, list_mode, timestamp_str):
     """
     if list_mode == 1:
         print("\n正在导出好友列表...")
-        users_to_export = {uid: info for uid, info in profile_mgr.all_users.items() if info.get('is_friend')}
+        uids_to_export = [uid for uid in profile_mgr.qq if uid in profile_mgr.friend_uids]
         base_filename = _FRIENDS_LIST_FILENAME
     else: # list_mode == 2
         print("\n正在导出全部缓存用户列表...")
-        users_to_export = profile_mgr.all_users
+        uids_to_export = list(profile_mgr.qq)
         base_filename = _ALL_USERS_LIST_FILENAME
 
     name, ext = os.path.splitext(base_filename)
     filename = f"{name}{timestamp_str}{ext}"
     output_path = os.path.join(OUTPUT_DIR, filename)
     
-    count = 0
+    # 每位用户拼成一段文本，最后一次写入
+    nickname, remark, qq, qid, signature = profile_mgr.nickname, profile_mgr.remark, profile_mgr.qq, profile_mgr.qid, profile_mgr.signature
+    entries = [
+        f"----------------------------------------\n昵称: {nickname[uid]}\n备注: {remark[uid]}\nQQ: {qq[uid]}\nUID: {uid}\nQID: {qid[uid]}\n签名: {signature[uid]}\n"
+        for uid in uids_to_export if uid != profile_mgr.my_uid # 不导出自己
+    ]
+    count = len(entries)
     with open(output_path, "w", encoding="utf-8") as f:
-        for uid, info in users_to_export.items():
-            if uid == profile_mgr.my_uid: continue # 不导出自己
-            
-            f.write("----------------------------------------\n")
-            f.write(f"昵称: {info.get('nickname', 'N/A')}\n")
-            f.write(f"备注: {info.get('remark', 'N/A')}\n")
-            f.write(f"QQ: {info.get('qq', 'N/A')}\n")
-            f.write(f"UID: {uid}\n")
-            f.write(f"QID: {info.get('qid', 'N/A')}\n")
-            f.write(f"签名: {info.get('signature', 'N/A')}\n")
-            count += 1
+        f.writelines(entries)
     
     print(f"\n处理完成！共导出 {count} 位用户的信息到 {output_path}")
 
@@ -1661,10 +2268,14 @@ QQ NT 聊天记录导出工具
     parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=descript_text)
     parser.add_argument('--input', type=str, required=True, help='输入目录，应包含解密后的数据库文件。')
     parser.add_argument('--output', type=str, required=True, help='输出目录。')
+    parser.add_argument('--strict-cache', action='store_true', help='使用SHA256校验非好友缓存 (较慢)，默认只比较数据库文件的大小和修改时间。')
+    parser.add_argument('--reply-cache-size', type=int, default=_REPLY_CACHE_SIZE, help=f'缓存最近多少条消息的原文用于显示引用内容，0 表示不限制 (默认 {_REPLY_CACHE_SIZE})。')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='解析消息使用的进程数，默认为 CPU 核心数。')
+    parser.add_argument('--gzip', action='store_true', help='将聊天记录直接写为 .gz 压缩文件，省去导出后再压缩。')
     args = parser.parse_args()
 
     # 设置基础路径变量
-    global DB_PATH, PROFILE_DB_PATH, OUTPUT_DIR, CONFIG_PATH, TEMPLATE_DIR_PATH, NON_FRIENDS_CACHE_PATH
+    global DB_PATH, PROFILE_DB_PATH, OUTPUT_DIR, CONFIG_PATH, TEMPLATE_DIR_PATH, NON_FRIENDS_CACHE_PATH, STRICT_CACHE, GZIP_OUTPUT, _DECODE_POOL
     input_dir = args.input
     output_dir = args.output
     script_dir = os.path.dirname(os.path.abspath(__file__))
@@ -1673,6 +2284,9 @@ QQ NT 聊天记录导出工具
     CONFIG_PATH = os.path.join(script_dir, _CONFIG_FILENAME)
     TEMPLATE_DIR_PATH = os.path.join(script_dir, _TEMPLATE_DIR_NAME)
     NON_FRIENDS_CACHE_PATH = os.path.join(script_dir, _NON_FRIENDS_CACHE_FILENAME)
+    STRICT_CACHE = args.strict_cache
+    GZIP_OUTPUT = args.gzip
+    MESSAGE_CONTENT_CACHE.maxsize = SALVAGE_CACHE.maxsize = args.reply_cache_size or None
 
 
     print("===== QQ聊天记录导出工具 =====")
@@ -1743,7 +2357,7 @@ QQ NT 聊天记录导出工具
                 if selection == -2: # 非好友
                     target_uids = profile_mgr.non_friend_uids
                 else: # 普通分组
-                    target_uids = [uid for uid, info in profile_mgr.all_users.items() if info.get('group_id') == selection and info.get('is_friend')]
+                    target_uids = [uid for uid, gid in profile_mgr.group_id.items() if gid == selection and uid in profile_mgr.friend_uids]
                 scope_info = {'type': 'timeline', 'selection_mode': 'group', 'details': {'gid': selection, 'count': len(target_uids)}}
         elif mode == 3 or mode == 6:
             target_uids = select_friends(profile_mgr, config_mgr, path_title)
@@ -1761,15 +2375,19 @@ QQ NT 聊天记录导出工具
             "name_style": config_mgr.config.get('name_style', 'default'),
             "name_format": config_mgr.config.get('name_format', ''),
             "profile_mgr": profile_mgr, "run_timestamp": run_timestamp,
-            "export_config": config_mgr.config
+            "export_config": config_mgr.config, "is_timeline": is_timeline_mode
         }
         
-        if not os.path.exists(DB_PATH):
-            print(f"错误: 消息数据库文件 '{DB_PATH}' 不存在。")
+        try:
+            con = _connect_readonly(f"file:{DB_PATH}?mode=ro")
+        except sqlite3.OperationalError as e:
+            print(f"错误: 无法打开消息数据库文件 '{DB_PATH}'。 {e}")
             return
 
+        jobs = args.jobs or os.cpu_count() or 1
+        _DECODE_POOL = _open_decode_pool(jobs)
         try:
-            with sqlite3.connect(f"file:{DB_PATH}?mode=ro", uri=True) as con:
+            with con:
                 if is_timeline_mode:
                     export_timeline(con, config, target_uids, scope_info)
                 else: # 单独文件模式
@@ -1778,10 +2396,10 @@ QQ NT 聊天记录导出工具
                         groups_data = {}
                         # 处理好友
                         for uid in profile_mgr.friend_uids:
-                            gid = profile_mgr.all_users.get(uid, {}).get('group_id', -1)
+                            gid = profile_mgr.group_id.get(uid, -1)
                             if gid not in groups_data:
                                 g_name = profile_mgr.group_info.get(gid, f"分组{gid}")
-                                safe_g_name = re.sub(r'[\\/*?:"<>|]', "_", f"{gid}_{g_name}")
+                                safe_g_name = f"{gid}_{g_name}".translate(_SANITIZE_TABLE)
                                 g_dir = os.path.join(OUTPUT_DIR, "Individual", "Friends", safe_g_name)
                                 groups_data[gid] = {'dir': g_dir, 'users': []}
                             groups_data[gid]['users'].append(uid)
@@ -1793,16 +2411,13 @@ QQ NT 聊天记录导出工具
                             groups_data[non_friend_gid] = {'dir': non_friend_dir, 'users': profile_mgr.non_friend_uids}
 
                         total_users_count = len(profile_mgr.friend_uids) + (len(profile_mgr.non_friend_uids) if config_mgr.config.get('export_non_friends') else 0)
-                        current_user_index = 0
                         
-                        sorted_gids = sorted(groups_data.keys())
-                        for gid in sorted_gids:
+                        batches = []
+                        for gid in sorted(groups_data.keys()):
                             group_info_struct = groups_data[gid]
-                            print(f"\n以下文件导出到 \"{os.path.relpath(group_info_struct['dir'], output_dir)}\"")
-                            for user_uid in group_info_struct['users']:
-                                current_user_index += 1
-                                individual_scope_info = {'type': 'individual', 'friend_uid': user_uid}
-                                export_one_on_one(con, user_uid, config, individual_scope_info, group_info_struct['dir'], current_user_index, total_users_count)
+                            title = f"\n以下文件导出到 \"{os.path.relpath(group_info_struct['dir'], output_dir)}\""
+                            batches.append((group_info_struct['dir'], title, group_info_struct['users']))
+                        _export_friends(con, config, batches, total_users_count, jobs)
                     else:
                         output_dir = os.path.join(OUTPUT_DIR, "Individual")
                         if mode == 5:
@@ -1811,14 +2426,11 @@ QQ NT 聊天记录导出工具
                                  output_dir = os.path.join(output_dir, "Friends", name)
                              else: # 普通分组
                                  name = profile_mgr.group_info.get(selection, f"分组{selection}")
-                                 safe_name = re.sub(r'[\\/*?:"<>|]', "_", f"{selection}_{name}")
+                                 safe_name = f"{selection}_{name}".translate(_SANITIZE_TABLE)
                                  output_dir = os.path.join(output_dir, "Friends", safe_name)
                         
-                        print(f"\n以下文件将导出到 \"{os.path.relpath(output_dir, output_dir)}\"")
-                        total = len(target_uids)
-                        for i, uid in enumerate(target_uids):
-                            individual_scope_info = {'type': 'individual', 'friend_uid': uid}
-                            export_one_on_one(con, uid, config, individual_scope_info, output_dir, i + 1, total)
+                        title = f"\n以下文件将导出到 \"{os.path.relpath(output_dir, output_dir)}\""
+                        _export_friends(con, config, [(output_dir, title, target_uids)], len(target_uids), jobs)
 
         except sqlite3.Error as e:
             print(f"\n数据库错误: {e}")
@@ -1826,6 +2438,10 @@ QQ NT 聊天记录导出工具
             print(f"\n发生未知错误: {e}")
             import traceback
             traceback.print_exc()
+        finally:
+            if _DECODE_POOL is not None:
+                _DECODE_POOL.shutdown(cancel_futures=True)
+                _DECODE_POOL = None
             
         break # 任务完成，退出主循环
 
@@ -1,23 +1,76 @@
 import sqlite3
 import json
+import multiprocessing
 import os
+import queue
+import threading
 from datetime import datetime
-import base64
+import functools
 import sys
 import warnings
+from contextlib import contextmanager
+from pathlib import Path
+from binascii import b2a_base64
+from concurrent.futures import ProcessPoolExecutor
+from json.encoder import encode_basestring
 
 import mods.schema as dbsma
 import mods.msg as msg
 
 META = {"key": "2", "title": "[Dev] 导出 C2C 消息", "order": 2}
 
-try:
-    warnings.filterwarnings("ignore", message="pkg_resources is deprecated.*")
-    import blackboxprotobuf
+# 每批从游标读取的行数
+FETCH_SIZE = 4096
+# 输出缓冲区大小, 攒满后整块写入
+WRITE_BUFFER_SIZE = 1 << 20
+# 等待写入线程处理的缓冲块数量上限
+WRITER_QUEUE_SIZE = 8
+# 队列满时检查写入线程是否仍在运行的间隔 (秒)
+WRITER_POLL_INTERVAL = 1.0
+# 进程池每次分发给子进程的消息数
+POOL_CHUNK_SIZE = 256
+
+# 只读顺序扫描时的 SQLite 调优
+# 按时间排序的查询可能要把整张表连同消息内容放进临时存储排序, 临时存储保持默认 (磁盘),
+# 免得大数据库在内存较小的设备 (如 Termux) 上耗尽内存
+READ_PRAGMAS = (
+    "query_only=ON",
+    "mmap_size=1073741824",
+    "cache_size=-262144",
+    "synchronous=OFF",
+)
+
+# 输出行 "[时间] 发送者 -> 接收者\nJSON\n" 的固定片段
+_OPEN = b"["
+_CLOSE = b"] "
+_ARROW = b" -> "
+_NL = b"\n"
+
+# 导入较慢, 推迟到 run() 中加载; fork 出的子进程直接继承
+blackboxprotobuf = None
+
+
+def _import_blackboxprotobuf():
+    global blackboxprotobuf
+    if blackboxprotobuf is not None:
+        return
+
+    try:
+        warnings.filterwarnings("ignore", message="pkg_resources is deprecated.*")
+        import blackboxprotobuf as bbpb
+
+    except ImportError:
+        msg.print("使用 'pip install -r requirements.txt' 安装缺少的依赖包。")
+        sys.exit(1)
+
+    blackboxprotobuf = bbpb
 
+
+# 可选依赖, 缺少时使用标准库 json
+try:
+    import orjson
 except ImportError:
-    msg.print("使用 'pip install -r requirements.txt' 安装缺少的依赖包。")
-    sys.exit(1)
+    orjson = None
 
 
 # 消息数据库中的 protobuf 字典
@@ -28,80 +81,343 @@ except ImportError:
     sys.exit(1)
 
 
-def recursive_decode(data):
-    if not isinstance(data, (bytes, bytearray)):
-        return data
-
-    if len(data) == 0:
-        return data
-
+def _decode_bytes(data):
+    """
+    解析一层 protobuf, 失败返回 None。
+    每条消息都重新推断类型: 套用别的消息推断出的 typedef 时, 嵌套消息可能被静默解析成 bytes。
+    """
     try:
-        message, _ = blackboxprotobuf.decode_message(data)
-
-        decoded_message = {}
-        for key, value in message.items():
-            if isinstance(value, list):
-                decoded_message[key] = [recursive_decode(item) for item in value]
-            else:
-                decoded_message[key] = recursive_decode(value)
-        return decoded_message
+        return blackboxprotobuf.decode_message(data)[0]
     except Exception:
-        return data
+        return None
 
 
 def json_serializer(obj):
-    if isinstance(obj, (bytes, bytearray)):
-        try:
-            return obj.decode("utf-8")
-        except UnicodeDecodeError:
-            return "BASE64:" + base64.b64encode(obj).decode("ascii")
+    t = type(obj)
+    if t is bytes or t is bytearray:
+        # 首字节不可能作为 UTF-8 起始字节时, 跳过必然失败的解码
+        if not obj or obj[0] < 0x80 or 0xC2 <= obj[0] <= 0xF4:
+            try:
+                return obj.decode("utf-8")
+            except UnicodeDecodeError:
+                pass
+        return "BASE64:" + b2a_base64(obj, newline=False).decode("ascii")
     return str(obj)
 
 
-def map_protobuf_keys(data):
+def _tiny_dump(obj):
+    """直接拼出只含少量 int/str 字段的 dict 的紧凑 JSON, 不经过通用编码器。"""
+    return (
+        "{"
+        + ",".join(
+            f"{encode_basestring(key)}:"
+            f"{encode_basestring(value) if type(value) is str else value}"
+            for key, value in obj.items()
+        )
+        + "}"
+    ).encode("utf-8")
+
+
+def _is_tiny(obj):
+    if type(obj) is not dict or len(obj) > 2:
+        return False
+    for value in obj.values():
+        t = type(value)
+        if t is not int and t is not str:
+            return False
+    return True
+
+
+def make_dumps(pretty=False):
+    """返回将解析结果编码为 UTF-8 JSON bytes 的函数, 优先使用 orjson。"""
+    json_options = {"indent": 2} if pretty else {"separators": (",", ":")}
+
+    def json_dumps(obj):
+        if not pretty and _is_tiny(obj):
+            return _tiny_dump(obj)
+        return json.dumps(
+            obj, ensure_ascii=False, default=json_serializer, **json_options
+        ).encode("utf-8")
+
+    if orjson is None:
+        return json_dumps
+
+    option = orjson.OPT_INDENT_2 if pretty else 0
+
+    def orjson_dumps(obj):
+        try:
+            return orjson.dumps(obj, default=json_serializer, option=option)
+        except TypeError:
+            # 超出 64 位的整数等 orjson 不支持的值, 交给标准库处理
+            return json_dumps(obj)
+
+    return orjson_dumps
+
+
+# 字段 ID -> 可读键名, None 表示丢弃; 未登记的 ID 在首次出现时补入
+KEY_REWRITE = {
+    key: None
+    if key in IGNORE_IDS or len(key) != 5
+    else sys.intern(PROTO_FIELD_MAP.get(key, key))
+    for key in PROTO_FIELD_MAP.keys() | IGNORE_IDS
+}
+MSG_TYPE_KEY = sys.intern("MSG_TYPE")
+# MSG_TYPE 编号是较小的连续整数, 按下标查表; 未登记的编号映射为自身
+MSG_TYPE_NAMES = [
+    MSG_TYPE_MAP.get(code, code) for code in range(max(MSG_TYPE_MAP, default=-1) + 1)
+]
+_MISSING = object()
+
+
+def _rewrite_key(key_str):
+    readable_key = (
+        None if key_str in IGNORE_IDS or len(key_str) != 5 else sys.intern(key_str)
+    )
+    KEY_REWRITE[key_str] = readable_key
+    return readable_key
+
+
+def decode_and_map(data):
     """
-    递归将 protobuf 的数字 key 转换为可读字符串，
-    并对特定的枚举值进行翻译。
+    逐层解析多层套娃的 protobuf, 同时将数字 key 转换为可读字符串,
+    并对特定的枚举值进行翻译。被过滤的字段不会被解析, 无法解析的 bytes 原样保留。
     """
-    if isinstance(data, list):
-        return [map_protobuf_keys(item) for item in data]
+    t = type(data)
+    if (t is not bytes and t is not bytearray) or not data:
+        return data
 
-    if not isinstance(data, dict):
+    message = _decode_bytes(data)
+    if message is None:
         return data
 
-    new_data = {}
-    for key, value in data.items():
-        key_str = str(key)
+    # 热循环中用到的全局名称绑定为局部变量
+    key_rewrite_get = KEY_REWRITE.get
+    decode_bytes = _decode_bytes
+    msg_type_names = MSG_TYPE_NAMES
+    msg_type_count = len(MSG_TYPE_NAMES)
+    missing = _MISSING
+    msg_type_key = MSG_TYPE_KEY
+
+    # 栈帧: (源节点, 输出节点, 是否继续解析其中的 bytes)
+    # 只有自行解析出的消息才需要继续解析, blackboxprotobuf 已展开的子消息仅转换 key
+    root = {}
+    stack = [(message, root, True)]
+    push = stack.append
+    pop = stack.pop
+    while stack:
+        src, dst, decode = pop()
+        if type(src) is dict:
+            for key, value in src.items():
+                key_str = str(key)
+                readable_key = key_rewrite_get(key_str, missing)
+                if readable_key is missing:
+                    readable_key = _rewrite_key(key_str)
+                # 过滤极少量的长短字段
+                if readable_key is None:
+                    continue
+
+                t = type(value)
+                if t is dict:
+                    dst[readable_key] = child = {}
+                    push((value, child, False))
+                elif t is list:
+                    dst[readable_key] = child = []
+                    push((value, child, decode))
+                elif (
+                    decode
+                    and (t is bytes or t is bytearray)
+                    and value
+                    and (inner := decode_bytes(value)) is not None
+                ):
+                    dst[readable_key] = child = {}
+                    push((inner, child, True))
+                elif readable_key is msg_type_key and t is int:
+                    dst[readable_key] = (
+                        msg_type_names[value]
+                        if value < msg_type_count and value >= 0
+                        else value
+                    )
+                else:
+                    dst[readable_key] = value
+        else:
+            for item in src:
+                t = type(item)
+                if t is dict:
+                    child = {}
+                    push((item, child, False))
+                elif t is list:
+                    child = []
+                    push((item, child, False))
+                elif (
+                    decode
+                    and (t is bytes or t is bytearray)
+                    and item
+                    and (inner := decode_bytes(item)) is not None
+                ):
+                    child = {}
+                    push((inner, child, True))
+                else:
+                    dst.append(item)
+                    continue
+                dst.append(child)
+
+    return root
+
+
+def connect_ro(db_path):
+    """
+    以只读方式打开数据库, 并针对一次性顺序读取调优。
+    调优参数只影响速度, 某项不被支持时跳过, 不影响读取。
+    """
+    conn = sqlite3.connect(f"{Path(db_path).absolute().as_uri()}?mode=ro", uri=True)
+    for pragma in READ_PRAGMAS:
+        try:
+            conn.execute(f"PRAGMA {pragma}")
+        except sqlite3.Error:
+            pass
+    return conn
 
-        # 过滤极少量的长短字段
-        if key_str in IGNORE_IDS or len(key_str) != 5:
-            continue
 
-        # 如果在映射表中，使用可读名称；否则保留原始 ID
-        readable_key = PROTO_FIELD_MAP.get(key_str, key_str)
-        processed_value = map_protobuf_keys(value)
+class _EncodedCache(dict):
+    """缓存字符串的 UTF-8 编码结果, 用于反复出现的发送者/接收者 UID。"""
 
-        match readable_key:
-            case "MSG_TYPE":
-                if isinstance(processed_value, int):
-                    processed_value = MSG_TYPE_MAP.get(processed_value, processed_value)
+    def __missing__(self, key):
+        value = self[key] = str(key).encode("utf-8")
+        return value
 
-            case _:
-                pass
 
-        new_data[readable_key] = processed_value
+@functools.lru_cache(maxsize=4096)
+def _format_minute(minute):
+    """格式化到分钟, 相邻消息大多落在同一分钟内。"""
+    return datetime.fromtimestamp(minute * 60).strftime("%Y-%m-%d %H:%M:")
 
-    return new_data
+
+def format_time(ts):
+    try:
+        seconds = ts if type(ts) is int else int(ts)
+        return f"{_format_minute(seconds // 60)}{seconds % 60:02d} ({ts})"
+    except (ValueError, TypeError, OverflowError, OSError):
+        return str(ts)
+
+
+# 解析进程 (或串行时的主进程) 使用的编码函数, 由 _init_worker 初始化
+_dumps = None
+
+
+def _init_worker(pretty):
+    global _dumps
+    _dumps = make_dumps(pretty)
+
+
+def _decode_and_dump(msg_blob):
+    return _dumps(decode_and_map(msg_blob))
+
+
+def _open_pool(jobs, pretty):
+    """创建解析进程池, 平台不支持多进程 (如 Android 缺少 sem_open) 时返回 None。"""
+    if jobs <= 1:
+        return None
+    try:
+        pool = ProcessPoolExecutor(
+            jobs,
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=_init_worker,
+            initargs=(pretty,),
+        )
+        # 在启动其他线程之前 fork 出全部子进程
+        pool.submit(int).result()
+    except (ImportError, NotImplementedError, OSError, ValueError):
+        return None
+    return pool
+
+
+def _encoded_batches(cursor, pool):
+    """
+    按批读取消息行, 拆成 (时间戳, 发送者, 接收者) 三列和解析后的 JSON bytes 迭代器。
+    使用进程池时先提交下一批再产出当前批, 让解析与写出重叠。
+    """
+    pending = None
+    while True:
+        rows = cursor.fetchmany()
+        if rows:
+            ts_col, sender_col, peer_col, blob_col = zip(*rows)
+            if pool is None:
+                encoded = map(_decode_and_dump, blob_col)
+            else:
+                encoded = pool.map(
+                    _decode_and_dump, blob_col, chunksize=POOL_CHUNK_SIZE
+                )
+
+        if pending is not None:
+            yield pending
+        if not rows:
+            return
+        pending = (ts_col, sender_col, peer_col, encoded)
+
+
+def _write_chunks(f_out, chunks, errors):
+    """
+    写入线程: 依次写出队列中的数据块, 收到 None 时结束。
+    I/O 错误记入 errors, 由主线程抛出; 其他异常属于程序错误, 直接在本线程抛出。
+    """
+    while True:
+        chunk = chunks.get()
+        if chunk is None:
+            return
+        # 写入出错后继续消费队列, 避免生产者阻塞在 put() 上
+        if errors:
+            continue
+        try:
+            f_out.write(chunk)
+        except (OSError, ValueError) as e:
+            errors.append(e)
+
+
+@contextmanager
+def _background_writer(f_out):
+    """
+    在独立线程中写文件, 让磁盘 I/O 与消息解析重叠。
+    产出提交数据块的函数, 退出时等待全部写完, 并抛出写入线程中的异常。
+    """
+    chunks = queue.Queue(maxsize=WRITER_QUEUE_SIZE)
+    errors = []
+    writer = threading.Thread(
+        target=_write_chunks, args=(f_out, chunks, errors), daemon=True
+    )
+
+    def submit(chunk):
+        # 写入线程因程序错误退出后不再消费队列, 不能一直阻塞在 put() 上
+        while True:
+            try:
+                return chunks.put(chunk, timeout=WRITER_POLL_INTERVAL)
+            except queue.Full:
+                if not writer.is_alive():
+                    raise RuntimeError("写入线程异常退出") from None
+
+    writer.start()
+    try:
+        yield submit
+    finally:
+        submit(None)
+        writer.join()
+    if errors:
+        raise errors[0]
+    # 正常结束的写入线程会取走最后的 None, 队列不空说明它提前退出了
+    if not chunks.empty():
+        raise RuntimeError("写入线程异常退出")
 
 
 def run(args):
+    _import_blackboxprotobuf()
+
     db_msg = os.path.join(args.input, dbsma.DB_MSG)
     db_profile = os.path.join(args.input, dbsma.DB_PROFILE)
 
     output_file_path = os.path.join(args.output, "parsed_messages.txt")
     conn = None
+    pool = None
     try:
-        conn = sqlite3.connect(db_msg)
+        conn = connect_ro(db_msg)
         cursor = conn.cursor()
 
         msg.msg1("正在统计...")
@@ -110,40 +426,61 @@ def run(args):
 
         # 查询 C2C 消息表
         query = f'SELECT "{dbsma.Col_timespan}", "{dbsma.Col_sender_uid}", "{dbsma.Col_peer_uid}", "{dbsma.Col_msg}" FROM {dbsma.Table_C2c_msg} ORDER BY "{dbsma.Col_timespan}" ASC'
+        cursor.arraysize = FETCH_SIZE
         cursor.execute(query)
 
+        _init_worker(args.pretty)
+        pool = _open_pool(args.jobs or os.cpu_count() or 1, args.pretty)
+
         msg.msg1("导出 C2C 消息...")
-        with open(output_file_path, "w", encoding="utf-8") as f_out:
+        with (
+            open(output_file_path, "wb", buffering=WRITE_BUFFER_SIZE) as f_out,
+            _background_writer(f_out) as submit,
+            msg.Progress(
+                msg.BarColumn(),
+                msg.MofNCompleteColumn(),
+                console=msg.console,
+                auto_refresh=False,
+            ) as progress,
+        ):
+            task = progress.add_task(" ", total=total_count)
+            uid_bytes = _EncodedCache()
+            buf = bytearray()
             count = 0
-            for row in msg.track(cursor, total=total_count, description=" "):
-                ts, sender, peer, msg_blob = row
-                if not sender:
-                    sender = "[系统提示]"
-                if sender == peer:
-                    sender = "u_MyUID"
-                try:
-                    dt_object = datetime.fromtimestamp(int(ts))
-                    time_str = f"{dt_object:%Y-%m-%d %H:%M:%S} ({ts})"
-                except (ValueError, TypeError):
-                    time_str = str(ts)
-
-                # 递归解析数据
-                # decoded_struct = recursive_decode(msg_blob)
-                raw_decoded = recursive_decode(msg_blob)
-                decoded_struct = map_protobuf_keys(raw_decoded)
-
-                json_content = json.dumps(
-                    decoded_struct,
-                    ensure_ascii=False,
-                    default=json_serializer,
-                    indent=2,
-                )
-
-                # 构造输出行
-                line = f"[{time_str}] {sender} -> {peer}\n{json_content}\n"
-                f_out.write(line)
-
-                count += 1
+            for ts_col, sender_col, peer_col, encoded in _encoded_batches(cursor, pool):
+                for ts, sender, peer, json_bytes in zip(
+                    ts_col, sender_col, peer_col, encoded
+                ):
+                    if not sender:
+                        sender = "[系统提示]"
+                    if sender == peer:
+                        sender = "u_MyUID"
+                    # 构造输出行
+                    buf += b"".join(
+                        (
+                            _OPEN,
+                            format_time(ts).encode("utf-8"),
+                            _CLOSE,
+                            uid_bytes[sender],
+                            _ARROW,
+                            uid_bytes[peer],
+                            _NL,
+                            json_bytes,
+                            _NL,
+                        )
+                    )
+                    if len(buf) > WRITE_BUFFER_SIZE:
+                        # 整块交给写入线程, 不再复用以免与写入竞争
+                        submit(buf)
+                        buf = bytearray()
+
+                count += len(ts_col)
+                # 不启用自动刷新线程, 每批刷新一次进度
+                progress.advance(task, len(ts_col))
+                progress.refresh()
+
+            if buf:
+                submit(buf)
 
         msg.msg1(f"共导出 {count} 条消息到 {output_file_path}")
 
@@ -152,5 +489,7 @@ def run(args):
     except Exception as e:
         msg.error(f"{e}")
     finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
         if conn:
             conn.close()
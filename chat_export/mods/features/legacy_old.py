@@ -4,6 +4,9 @@ META = {"key": "1", "title": "聊天记录导出工具", "order": 1}
 
 
 def run(args):
-    utils.start_new_py(
-        args.base_dir / "QQRootFastDecrypt/old.py", ["--input", args.input, "--output", args.output]
-    )
+    script_args = ["--input", args.input, "--output", args.output]
+    if args.jobs:
+        script_args += ["--jobs", str(args.jobs)]
+    if args.gzip:
+        script_args.append("--gzip")
+    utils.start_new_py(args.base_dir / "QQRootFastDecrypt/old.py", script_args)
@@ -1,11 +1,48 @@
+import ast
 import pkgutil
 import importlib
+import importlib.util
+from pathlib import Path
+
+
+def _read_meta(path):
+    """
+    从模块源码中静态读取 META 字典, 不执行模块本身。
+    模块没有字面量形式的 META 或没有 run 函数时返回 None。
+    """
+    tree = ast.parse(path.read_text(encoding="utf-8"), filename=str(path))
+
+    meta = None
+    has_run = False
+    for node in tree.body:
+        if isinstance(node, ast.Assign):
+            if any(isinstance(t, ast.Name) and t.id == "META" for t in node.targets):
+                try:
+                    meta = ast.literal_eval(node.value)
+                except ValueError:
+                    return None
+        elif isinstance(node, ast.FunctionDef) and node.name == "run":
+            has_run = True
+
+    if not has_run or not isinstance(meta, dict):
+        return None
+    return meta
+
+
+def _lazy_run(name):
+    """返回一个包装函数, 首次调用时才导入模块并执行其 run。"""
+
+    def run(args):
+        return importlib.import_module(name).run(args)
+
+    return run
 
 
 def load_features():
     """
     扫描 features 包下的所有模块，返回一个字典。
     格式: { '按键': { 'meta': META, 'func': run_func } }
+    模块只在对应功能被选中时才导入, 避免菜单启动时加载其依赖。
     """
     features = {}
 
@@ -14,17 +51,21 @@ def load_features():
     package_path = feature_pkg.__path__
     prefix = feature_pkg.__name__ + "."
 
-    for _, name, _ in pkgutil.iter_modules(package_path, prefix):
+    for module_info in pkgutil.iter_modules(package_path, prefix):
+        name = module_info.name
         try:
-            module = importlib.import_module(name)
+            spec = importlib.util.find_spec(name)
+            if spec is None or spec.origin is None:
+                continue
 
             # 检查是否符合协议 (必须有 META 和 run)
-            if hasattr(module, "META") and hasattr(module, "run"):
-                meta = module.META
-                key = str(meta.get("key", "")).upper()
+            meta = _read_meta(Path(spec.origin))
+            if meta is None:
+                continue
 
-                if key:
-                    features[key] = {"meta": meta, "func": module.run}
+            key = str(meta.get("key", "")).upper()
+            if key:
+                features[key] = {"meta": meta, "func": _lazy_run(name)}
         except Exception:
             pass
 
@@ -3,7 +3,7 @@ import sys
 try:
     from rich import print
     from rich.console import Console
-    from rich.progress import track
+    from rich.progress import BarColumn, MofNCompleteColumn, Progress
     from rich.rule import Rule
 
     console = Console()
@@ -22,6 +22,17 @@ Github: https://github.com/miniyu157/qq-dump
         "--input", required=True, help=f"文件夹, 存放 {dbsma.DB_MSG},{dbsma.DB_PROFILE}"
     )
     parser.add_argument("--output", required=True, help="输出结果文件的文件夹路径。")
+    parser.add_argument(
+        "--pretty", action="store_true", help="导出的 JSON 使用缩进格式 (体积约翻倍)。"
+    )
+    parser.add_argument(
+        "-j", "--jobs", type=int, help="解析消息使用的进程数, 默认为 CPU 核心数。"
+    )
+    parser.add_argument(
+        "--gzip",
+        action="store_true",
+        help="旧版导出工具将聊天记录直接写为 .gz 压缩文件。",
+    )
     return parser.parse_args()
 
 